@@ -1,10 +1,11 @@
 import bpy
-from bpy.props import (CollectionProperty, StringProperty)
+from bpy.props import (CollectionProperty, StringProperty, EnumProperty, IntProperty)
 import os
 import sys
+import time
 from pathlib import Path
 
-from .shared import (vpk)
+from .shared import (vpk, utils)
 from .source1 import (bsp, vtf, vmt, mdl)
 
 bl_info = {
@@ -24,17 +25,40 @@ bl_info = {
 #         ma = slot.material
 #         layout.label(text="/home/lucas/.steam/steam/steamapps/common/Team Fortress 2/tf/tf2_misc_dir.vpk", translate=False, icon='FILE')
 
+def update_content_cache_size(self, context):
+    vpk.content_cache.set_budget(self.content_cache_size * 1024 * 1024)
+
 class SourceSmoothiePreferences(bpy.types.AddonPreferences):
     bl_idname = __package__
     
     # game_paths: CollectionProperty(name="VPK (game) paths", type=bpy.types.OperatorFileListElement)
     vpk_path: StringProperty(name="Search directory")
+    mount_mode: EnumProperty(
+        name="Mount VPKs",
+        items=(
+            ("LAZY",        "On first use",         "Only find VPKs at startup, each one is read the first time a lookup needs it"),
+            ("BACKGROUND",  "In the background",    "Find VPKs at startup and read them on a background thread"),
+            ("STARTUP",     "At startup",           "Read every VPK before the addon finishes loading"),
+        ),
+        default="LAZY",
+    )
+    content_cache_size: IntProperty(
+        name="File cache size (MB)",
+        description="Memory used to keep recently read VMT/VTF/MDL files around during an import",
+        default=vpk.CONTENT_CACHE_BUDGET // (1024 * 1024),
+        min=0,
+        update=update_content_cache_size,
+    )
 
     def draw(self, context):
         layout = self.layout
         layout.label(text='Path to search for VPKs (restart required after changing):')
         row = layout.row()
         row.prop(self, 'vpk_path')
+        row = layout.row()
+        row.prop(self, 'mount_mode')
+        row = layout.row()
+        row.prop(self, 'content_cache_size')
 
 namespaces = {
     bsp,
@@ -44,12 +68,28 @@ namespaces = {
 }
 
 def mount_vpks():
-    paths = [str(x) for x in Path(bpy.context.preferences.addons[__name__].preferences.vpk_path).rglob("*_dir.vpk")]
+    preferences = bpy.context.preferences.addons[__name__].preferences
+    update_content_cache_size(preferences, bpy.context)
+
+    paths = [str(x) for x in Path(preferences.vpk_path).rglob("*_dir.vpk")]
     paths.reverse() # Hacky solution for TF2 textures
-    for vi, v in enumerate(paths):
-        print(f"\r[SourceSmoothie] Mounting VPKs {vi+1}/{len(paths)}", end='')
-        vpk.mount(v)
-    print("")
+
+    if(preferences.mount_mode != "STARTUP"):
+        vpk.mount_lazy(paths)
+        if(preferences.mount_mode == "BACKGROUND"):
+            vpk.start_background_mounting()
+        print(f"[SourceSmoothie] Found {len(paths)} VPKs, mounting them {'in the background' if preferences.mount_mode == 'BACKGROUND' else 'on first use'}")
+        return
+
+    print(f"[SourceSmoothie] Mounting {len(paths)} VPKs")
+    start = time.perf_counter()
+    timings = vpk.mount_many(paths)
+    for path, elapsed, error in sorted(timings, key=lambda t: t[1], reverse=True):
+        if(error):
+            print(f"[SourceSmoothie] {'failed'.rjust(10)} | {path}: {error}")
+        else:
+            print(f"[SourceSmoothie] {elapsed * 1000:8.1f}ms | {path}")
+    print(f"[SourceSmoothie] Mounted VPKs in {(time.perf_counter() - start) * 1000:.1f}ms")
 
 def register():
     for n in namespaces:
@@ -57,6 +97,7 @@ def register():
 
     bpy.utils.register_class(SourceSmoothiePreferences)
 
+    utils.CACHE_DIRECTORY = bpy.utils.user_resource('DATAFILES', path="sourcesmoothie_cache", create=True)
     mount_vpks()
 
 def unregister():
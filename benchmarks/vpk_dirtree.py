@@ -0,0 +1,83 @@
+# Compares the bulk VPK directory tree parser against the original byte-at-a-time parser
+# Usage (from the repository root): python benchmarks/vpk_dirtree.py [entry count]
+
+import io
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.binhelper import BinaryReader
+from shared.vpk import parse_dirtree
+
+EXTENSIONS = ["vmt", "vtf", "mdl", "vvd", "wav"]
+FILES_PER_DIRECTORY = 64
+
+
+def build_dirtree(entry_count):
+    tree = io.BytesIO()
+    per_extension = entry_count // len(EXTENSIONS)
+    for ext in EXTENSIONS:
+        tree.write(ext.encode() + b'\0')
+        for first in range(0, per_extension, FILES_PER_DIRECTORY):
+            tree.write(f"materials/synthetic/{ext}/dir{first // FILES_PER_DIRECTORY}".encode() + b'\0')
+            for i in range(first, min(first + FILES_PER_DIRECTORY, per_extension)):
+                preload = b'"LightmappedGeneric"' if ext == "vmt" and i % 4 == 0 else b''
+                tree.write(f"file_{i}".encode() + b'\0')
+                tree.write(struct.pack('<IHHIIH', i, len(preload), i % 32, i * 512, 512, 0xffff) + preload)
+            tree.write(b'\0')
+        tree.write(b'\0')
+    tree.write(b'\0')
+
+    return tree.getvalue()
+
+
+# The parser as it was before the bulk decoder, kept here as the baseline
+def parse_dirtree_legacy(data):
+    filelist = {}
+    br = BinaryReader(io.BytesIO(data))
+    while True:
+        extension = br.readString()
+        if(extension == ""):
+            break
+
+        paths = {}
+        while True:
+            path = br.readString()
+            if(path == ""):
+                break
+
+            while True:
+                filename = br.readString()
+                if(filename == ""):
+                    break
+
+                header = br.readt("IHHIIH")
+                paths[f"{path}/{filename}"] = (header[2], header[3], header[4])
+                br.seek(header[1])
+
+        filelist[extension] = paths
+
+    return filelist
+
+
+def bench(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name.rjust(16)} | {elapsed * 1000:10.1f}ms")
+    return result, elapsed
+
+
+if __name__ == "__main__":
+    entry_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    data = build_dirtree(entry_count)
+    print(f"Synthetic directory tree: {entry_count} entries, {len(data) / 1e6:.1f}MB")
+
+    legacy, legacy_time = bench("legacy", parse_dirtree_legacy, data)
+    (entries, columns), bulk_time = bench("bulk", parse_dirtree, data)
+
+    assert len(entries) == sum(len(p) for p in legacy.values())
+    print(f"{'speedup'.rjust(16)} | {legacy_time / bulk_time:10.1f}x")
@@ -7,26 +7,116 @@ from collections import namedtuple
 import contextlib
 
 def unpack_named(data: bytes, packing: str, nt: namedtuple):
-    return [nt._make(x) for x in struct.iter_unpack(packing, data)]
+    return [nt._make(x) for x in get_struct(packing).iter_unpack(data)]
 
 def unpack_iterative(data: bytes, packing: str):
-    return [x for x in struct.iter_unpack(packing, data)]
+    return list(get_struct(packing).iter_unpack(data))
 
 def unpack_iterative_single(data: bytes, packing: str):
-    return [x[0] for x in struct.iter_unpack(packing, data)]
-
-def try_decompress(data: bytes):
-    if(data[:4] == b'LZMA'):
-        actual_size = up('I', data[4:8])[0]
-        properties = up('5B', data[12:17])
-        new_header = pa('<5BQ', *properties, actual_size)
-        result = lzma.decompress(new_header + data[17:])
+    return [x[0] for x in get_struct(packing).iter_unpack(data)]
+
+LzmaHeader = namedtuple("LzmaHeader", "actual_size lzma_size properties")
+LZMA_HEADER_SIZE = 17
+
+def lzma_header(data: bytes):
+    """Parses the header of a Source LZMA block, returns None if `data` isn't compressed"""
+    if(len(data) < LZMA_HEADER_SIZE or data[:4] != b'LZMA'):
+        return None
+
+    actual_size, lzma_size = up('<II', data[4:12])
+    return LzmaHeader(actual_size, lzma_size, up('5B', data[12:17]))
+
+def try_decompress(data: bytes, max_size=None):
+    """Decompresses a Source LZMA block (anything else is returned as-is), with `max_size` only the first bytes of it"""
+    header = lzma_header(data)
+    if(header):
+        new_header = pa('<5BQ', *header.properties, header.actual_size)
+        if(max_size is None):
+            result = lzma.decompress(new_header + data[LZMA_HEADER_SIZE:])
+        else:
+            result = lzma.LZMADecompressor(lzma.FORMAT_ALONE).decompress(new_header + data[LZMA_HEADER_SIZE:], max_size)
     else:
-        result = data
+        result = data if max_size is None else data[:max_size]
 
     return result
 
+@functools.lru_cache(maxsize=None)
+def get_struct(packing: str):
+    return struct.Struct(packing)
+
+
+class BufferFile(io.IOBase):
+    """File-like object over `size` bytes at `offset` in an in-memory buffer (bytes, bytearray, mmap or memoryview)
+
+    `read()` returns bytes for compatibility with regular files, `getbuffer()` returns the underlying slice without copying
+    """
+    def __init__(self, buffer, offset=0, size=None):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = offset
+        self.size = len(self.view) - offset if size is None else size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self.view[self.start:self.start+self.size]
+
+    def read(self, size=-1):
+        if(size < 0 or self.pos + size > self.size):
+            size = max(self.size - self.pos, 0)
+        data = self.view[self.start+self.pos:self.start+self.pos+size].tobytes()
+        self.pos += size
+        return data
+
+    def readinto(self, b):
+        size = min(len(b), max(self.size - self.pos, 0))
+        b[:size] = self.view[self.start+self.pos:self.start+self.pos+size]
+        self.pos += size
+        return size
+
+    def find(self, sub: bytes, pos: int):
+        """Position of `sub` at or after `pos`, relative to the start of the file, or -1"""
+        end = self.start + self.size
+        if(hasattr(self.buffer, 'find')):
+            i = self.buffer.find(sub, self.start + pos, end)
+            return i - self.start if i >= 0 else -1
+
+        # memoryviews can't search, scan through them in small copied blocks instead
+        block = 256
+        i = self.start + pos
+        while i < end:
+            found = self.view[i:min(i + block + len(sub) - 1, end)].tobytes().find(sub)
+            if(found >= 0):
+                return i + found - self.start
+            i += block
+
+        return -1
+
+    def seek(self, offset, whence=0):
+        if(whence == 0):
+            self.pos = offset
+        elif(whence == 1):
+            self.pos += offset
+        elif(whence == 2):
+            self.pos = self.size + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
 class BinaryReader:
+    def __new__(cls, file=None):
+        # Readers over in-memory buffers skip the file API altogether
+        if(cls is BinaryReader and isinstance(file, BufferFile)):
+            cls = BufferReader
+        return super().__new__(cls)
+
     def __init__(self, file):
         if(file == None):
             self.is_valid = False
@@ -35,7 +125,12 @@ class BinaryReader:
         self.f = file
 
     def readt(self, packing: str):
-        return up(packing, self.f.read(struct.calcsize(packing)))
+        s = get_struct(packing)
+        return s.unpack(self.f.read(s.size))
+
+    def read_block(self, size: int, decompress=False):
+        data = self.f.read(size)
+        return try_decompress(data) if decompress else data
 
     def read_named(self, size: int, packing: str, nt: namedtuple, decompress=False):
         data = try_decompress(self.f.read(size)) if decompress else self.f.read(size)
@@ -47,7 +142,7 @@ class BinaryReader:
 
     def read_iterative_single(self, size: int, packing: str, decompress=False):
         data = try_decompress(self.f.read(size)) if decompress else self.f.read(size)
-        return [x[0] for x in struct.iter_unpack(packing, data)]
+        return [x[0] for x in get_struct(packing).iter_unpack(data)]
 
     def read(self, packing: str, size):
         return up(packing, self.f.read(size))[0]
@@ -89,3 +184,81 @@ class BinaryReader:
 
     def seek(self, offset, relative=True):
         self.f.seek(offset, 1 if relative else 0)
+
+
+
+U8 = get_struct('B')
+U16 = get_struct('H')
+U32 = get_struct('I')
+U64 = get_struct('Q')
+F32 = get_struct('f')
+
+
+class BufferReader(BinaryReader):
+    """BinaryReader over a BufferFile, values are unpacked straight from the buffer with cached structs
+
+    The position lives in the BufferFile, so code that uses `reader.f` directly stays in sync
+    """
+    def __init__(self, file: BufferFile):
+        super().__init__(file)
+        self.view = file.getbuffer()
+
+    def unpack(self, s: struct.Struct):
+        f = self.f
+        pos = f.pos
+        f.pos = pos + s.size
+        return s.unpack_from(self.view, pos)
+
+    def readt(self, packing: str):
+        return self.unpack(get_struct(packing))
+
+    def read_block(self, size: int, decompress=False):
+        f = self.f
+        data = self.view[f.pos:f.pos+size]
+        f.pos += size
+        return try_decompress(data) if decompress else data
+
+    def read_named(self, size: int, packing: str, nt: namedtuple, decompress=False):
+        return unpack_named(self.read_block(size, decompress), packing, nt)
+
+    def read_iterative(self, size: int, packing: str, decompress=False):
+        return unpack_iterative(self.read_block(size, decompress), packing)
+
+    def read_iterative_single(self, size: int, packing: str, decompress=False):
+        return unpack_iterative_single(self.read_block(size, decompress), packing)
+
+    def read(self, packing: str, size):
+        return self.unpack(get_struct(packing))[0]
+
+    def read8(self):
+        return self.unpack(U8)[0]
+
+    def read16(self):
+        return self.unpack(U16)[0]
+
+    def read32(self):
+        return self.unpack(U32)[0]
+
+    def read64(self):
+        return self.unpack(U64)[0]
+
+    def readFloat(self):
+        return self.unpack(F32)[0]
+
+    def readString(self, size=-1):
+        f = self.f
+        if(size == -1):
+            end = f.find(b'\0', f.pos)
+            if(end < 0):
+                end = f.size
+            data = self.view[f.pos:end].tobytes()
+            f.pos = min(end + 1, f.size)
+            return data.decode('ascii')
+        else:
+            return f.read(size).decode('utf-8')
+
+    def seek(self, offset, relative=True):
+        if(relative):
+            self.f.pos += offset
+        else:
+            self.f.pos = offset
@@ -8,10 +8,28 @@ class Mountable(ABC):
     def open_file(self, path):
         pass
     
+    # Same as open_file, for paths that already went through vpk.normalize_path
+    @abstractmethod
+    def open_normalized(self, path):
+        pass
+    
     @abstractmethod
     def has_file(self, path):
         pass
     
     @abstractmethod
     def fetch_filelist(self):
-        pass
\ No newline at end of file
+        pass
+
+    # Read several normalized paths at once, returns {path: bytes} for every path that could be read
+    def read_many(self, paths):
+        result = {}
+        for p in paths:
+            f = self.open_normalized(p)
+            if(f):
+                result[p] = f.read()
+
+        return result
+
+    def close(self):
+        pass
@@ -1,7 +1,70 @@
 import time
+import os
+import tempfile
 
 PRINT_BENCHMARKS = True
 
+# Overridden with a path inside Blender's user directory when the addon is registered
+CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "sourcesmoothie")
+
+# Size budget of the cache categories that get a new file for every version of their input (e.g. a map that's being
+# recompiled), the least recently used files are removed once a category goes over it
+CACHE_LIMITS = {
+    "bsp": 1024 * 1024 * 1024,
+}
+
+def get_cache_path(category: str, name: str):
+    """Path of a file in the cache. In categories with a limit, the file is marked as used and older files are pruned"""
+    directory = os.path.join(CACHE_DIRECTORY, category)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+
+    limit = CACHE_LIMITS.get(category)
+    if(limit is not None):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        prune_cache(directory, limit, path)
+
+    return path
+
+def prune_cache(directory: str, limit: int, keep: str):
+    """Removes the least recently used files (by modification time) of a cache directory until it's within `limit` bytes"""
+    files = []
+    used = 0
+    for entry in os.scandir(directory):
+        if(entry.is_file()):
+            stat = entry.stat()
+            used += stat.st_size
+            if(entry.path != keep):
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    for _, size, path in sorted(files):
+        if(used <= limit):
+            break
+        try:
+            os.remove(path)
+            used -= size
+        except OSError:
+            pass
+
+class cached_property:
+    """Property that's computed on first access and then stored on the instance (functools.cached_property needs Python 3.8)"""
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if(instance is None):
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
 def start_bench(s: str):
     if(PRINT_BENCHMARKS):
         print(f"{s.rjust(32)} | (running)", end='', flush=True)
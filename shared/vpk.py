@@ -2,44 +2,60 @@
 # This mess is only temporary. This system needs to be heavily optimised and moved around
 # VPKs are supposed, like a few other files (including BSP and ZIP), to be derived from a `Mountable` class which implements the necessary features that are currently defined in Vpk
 
-from .binhelper import BinaryReader
-import io
+from .binhelper import BufferFile
 import os
+import sys
 from sys import argv
 import time
+import mmap
+import struct
+import hashlib
+from array import array
+from collections import namedtuple
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
 from .mountable import Mountable
+from .utils import get_cache_path
 import zipfile
 
-class VpkFile(io.IOBase):
-    def __init__(self, vpk_path, offset, size):
-        self.file = open(vpk_path, 'rb')
-        self.offset = offset
-        self.size = size
-        self.pos = 0
-
-        self.file.seek(offset)
-
-    def read(self, size=-1):
-        if(size == -1):
-            size = self.size-self.pos
-            self.file.seek(self.offset+self.pos)
-            self.pos += size
-            return self.file.read(size)
-        else:
-            self.file.seek(self.offset+self.pos)
-            self.pos += size
-            return self.file.read(size)
-    
-    def seek(self, offset, whence=0):
-        if(whence == 0):
-            self.pos = offset
-        elif(whence == 1):
-            self.pos += offset
-        elif(whence == 2):
-            self.pos = self.size - offset
-    
-    def tell(self):
-        return self.pos
+class MappedArchive:
+    """Read-only memory map of a single archive file
+
+    Every entry opened from the archive is a slice of the same map, so a chunk costs one mapping per mount
+    no matter how many entries are read from it
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if(os.fstat(f.fileno()).st_size == 0):
+                # Empty files can't be mapped
+                self.map = None
+                self.view = memoryview(b'')
+            else:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+
+    def slice(self, offset, size):
+        return self.view[offset:offset+size]
+
+    def open(self, offset, size):
+        return VpkFile(self.map if self.map else b'', offset, size)
+
+    def close(self):
+        self.view.release()
+        if(self.map):
+            try:
+                self.map.close()
+            except BufferError:
+                # Entries handed out from this archive are still alive, the map is freed along with them
+                pass
+
+
+class VpkFile(BufferFile):
+    """File-like view of an archive entry, see BufferFile"""
+    pass
 
 
 # Split a path into the path and file extension
@@ -47,61 +63,207 @@ def split_path(path):
     return (path[:path.rfind('.')], path[path.rfind('.')+1:])
 
 
+def normalize_path(path):
+    return path.replace('\\', '/').strip('\0\r\n\t').lower()
+
+
 class ZipWrapper(Mountable):
-    def __init__(self, path):
-        self.file = zipfile.ZipFile(path)
+    """Zip archive mounted from a file, or from `data` (any bytes-like object) without touching the disk"""
+    def __init__(self, path, data=None):
+        self.file = zipfile.ZipFile(path if data is None else VpkFile(data))
         self.path = path
 
         self.fetch_filelist()
     
     def fetch_filelist(self):
-        self.filelist = {}
-        for p in self.file.namelist():
-            path, ext = split_path(p)
-            if(self.filelist.get(ext)):
-                self.filelist[ext] += path
-            else:
-                self.filelist[ext] = [path]
+        self.entries = {}
+        for n in self.file.namelist():
+            if(not n.endswith('/')):
+                self.entries.setdefault(normalize_path(n), n)
     
     def open_file(self, path):
-        path_noext, path_ext = split_path(path)
-        if(self.filelist.get(path_ext)):
-            for n in self.file.namelist():
-                if(n.lower() == path.lower()):
-                    try:
-                        f = self.file.open(n)
-
-                        # Make sure the file is readable
-                        # Python's zipfile is really strict when it comes to CRCs
-                        f.read(1)
-                        f.seek(0)
-
-                        return f
-                    except:
-                        return None
+        return self.open_normalized(normalize_path(path))
 
-        return None
+    def open_normalized(self, path):
+        n = self.entries.get(path)
+        if(n is None):
+            return None
 
-    def has_file(self, path):
-        path_noext, path_ext = split_path(path)
         try:
-            if(self.filelist.get(path_ext)):
-                for f in self.filelist[path_ext]:
-                    if(f.lower() == path_noext.lower()):
-                        return True
+            f = self.file.open(n)
+
+            # Make sure the file is readable
+            # Python's zipfile is really strict when it comes to CRCs
+            f.read(1)
+            f.seek(0)
+
+            return f
         except:
-            return False
+            return None
 
-        return False
+    def has_file(self, path):
+        return normalize_path(path) in self.entries
+
+    def get_crc(self, path):
+        return self.file.getinfo(self.entries[path]).CRC
+
+    def read_many(self, paths):
+        # Read members in the order they're stored in
+        result = {}
+        for p in sorted(paths, key=lambda p: self.file.getinfo(self.entries[p]).header_offset):
+            try:
+                result[p] = self.file.read(self.entries[p])
+            except:
+                pass
+
+        return result
+
+    def close(self):
+        self.file.close()
+
+
+# preload_offset is relative to the start of the directory tree, offset of entries stored in the _dir.vpk itself
+# (archive index 0x7fff) is relative to the end of it
+VpkEntry = namedtuple("VpkEntry", "crc archive_index offset size preload_offset preload_size")
+VPK_COLUMN_TYPECODES = 'IHIIIH'
+VPK_EMBEDDED_ARCHIVE = 0x7fff
+
+INDEX_CACHE_MAGIC = b'SSVI'
+INDEX_CACHE_VERSION = 2
+USE_INDEX_CACHE = True
+
+
+VPK_ENTRY_SIZE = 18 # crc (I), preload bytes (H), archive index (H), offset (I), size (I), terminator (H)
+
+# (field offset, typecode) of the VpkEntry columns that are stored in the 18 byte entry record
+VPK_RECORD_COLUMNS = {
+    'crc':              (0, 'I'),
+    'archive_index':    (6, 'H'),
+    'offset':           (8, 'I'),
+    'size':             (12, 'I'),
+    'preload_size':     (4, 'H'),
+}
+
+
+def gather_column(records: bytes, count: int, offset: int, typecode: str):
+    """Pull one little-endian field out of `count` packed entry records using strided slices"""
+    column = array(typecode)
+    width = column.itemsize
+    data = bytearray(count * width)
+    for k in range(width):
+        data[k::width] = records[offset+k::VPK_ENTRY_SIZE]
+    column.frombytes(data)
+    if(sys.byteorder == 'big'):
+        column.byteswap()
+
+    return column
+
+
+def parse_dirtree(data: bytes):
+    """Parse a VPK directory tree into a normalized path -> row dict and one array per VpkEntry field
+
+    Strings are located with `bytes.find`, entry records are copied out as-is and split into columns afterwards,
+    and all paths are decoded and lower-cased in one go once the whole tree has been walked
+    """
+    find = data.find
+    names = []
+    records = []
+    preloads = []
+    add_name = names.append
+    add_record = records.append
+
+    pos = 0
+    while True:
+        end = find(b'\0', pos)
+        extension = data[pos:end]
+        pos = end + 1
+        if(not extension):
+            break
+
+        suffix = b'' if extension == b' ' else b'.' + extension
+        while True:
+            end = find(b'\0', pos)
+            path = data[pos:end]
+            pos = end + 1
+            if(not path):
+                break
+
+            filenames = []
+            add_filename = filenames.append
+            while True:
+                end = find(b'\0', pos)
+                if(end == pos):
+                    pos += 1
+                    break
+
+                add_filename(data[pos:end])
+                pos = end + 1 + VPK_ENTRY_SIZE
+                add_record(data[end+1:pos])
+                if(data[end+5] or data[end+6]):
+                    # Remember where the preload bytes are and skip over them
+                    preloads.append((len(records) - 1, pos))
+                    pos += data[end+5] | (data[end+6] << 8)
+
+            # Build the full paths of the whole directory with a single join
+            if(filenames):
+                prefix = b'' if path == b' ' else path + b'/'
+                add_name(prefix + (suffix + b'\0' + prefix).join(filenames) + suffix)
+
+    count = len(records)
+    records = b''.join(records)
+    preload_offset = array('I', bytes(count * 4))
+    for row, offset in preloads:
+        preload_offset[row] = offset
+
+    columns = VpkEntry(preload_offset=preload_offset, **{
+        field: gather_column(records, count, offset, typecode) for field, (offset, typecode) in VPK_RECORD_COLUMNS.items()
+    })
+    names = b'\0'.join(names).decode('utf-8', 'replace').lower().split('\0') if count else []
+
+    entries = dict(zip(names, range(count)))
+    if(len(entries) != count):
+        # The same path shows up more than once, keep the first entry and drop the rows of the others
+        entries = {}
+        keep = []
+        for i, n in enumerate(names):
+            if(n not in entries):
+                entries[n] = len(keep)
+                keep.append(i)
+        columns = VpkEntry._make(array(c.typecode, (c[i] for i in keep)) for c in columns)
+
+    return entries, columns
+
+
+# Neighbouring entries closer together than this are read with a single sequential read
+READ_MANY_GAP = 64 * 1024
+
+
+def coalesce_reads(entries):
+    """Sort (offset, size, ...) tuples by offset and group them into runs that can be read in one go"""
+    run = []
+    run_end = 0
+    for e in sorted(entries, key=lambda e: e[0]):
+        if(run and e[0] > run_end + READ_MANY_GAP):
+            yield run
+            run = []
+        run.append(e)
+        run_end = max(run_end, e[0] + e[1])
+
+    if(run):
+        yield run
 
 
 class Vpk(Mountable):
     def __init__(self, path):
-        self.file = BinaryReader(open(path, 'rb'))
-        self.path_template = path.replace("dir", "%03d")
+        self.path = path
+        dir_index = path.rfind("dir")
+        self.path_template = path[:dir_index] + "%03d" + path[dir_index+3:]
+
+        # The _dir.vpk is mapped like any other chunk, preload bytes and embedded entries are served from it
+        self.dir_archive = MappedArchive(path)
+        self.chunks = {VPK_EMBEDDED_ARCHIVE: self.dir_archive}
 
-        sig = self.file.read32()
-        version = self.file.read32()
+        sig, version, self.dirtree_size = struct.unpack_from('<3I', self.dir_archive.view)
 
         if(sig != 0x55aa1234):
             raise Exception("Invalid VPK file (signature doesn't match)")
@@ -109,103 +271,225 @@ class Vpk(Mountable):
         if(version not in [1, 2]):
             raise Exception(f"Invalid/unknown VPK version {version}")
     
-        self.dirtree_size = self.file.read32()
         self.dirtree_offset = [12, 28][version-1]
-        
-        self.fetch_filelist()
+        self.embedded_offset = self.dirtree_offset + self.dirtree_size
+
+        if(not USE_INDEX_CACHE or not self.load_index_cache()):
+            self.fetch_filelist()
+            if(USE_INDEX_CACHE):
+                self.save_index_cache()
     
+    def get_entry(self, path):
+        i = self.entries.get(path)
+        if(i is None):
+            return None
+
+        return VpkEntry._make(c[i] for c in self.columns)
+
     def open_file(self, path):
-        path_noext = path[:path.rfind('.')].lower()
-        path_ext = path[path.rfind('.')+1:].lower()
+        return self.open_normalized(normalize_path(path))
 
+    def open_normalized(self, path):
+        f = self.get_entry(path)
+        if(f is None):
+            return None
 
-        if(self.filelist.get(path_ext)):
-            if(self.filelist[path_ext].get(path_noext)):
-                f = self.filelist[path_ext][path_noext]
-                if(f[0] == 0x7fff):
-                    # Not supported right now
-                    return None
-                    # return VpkFile(self.path, f[5], f[4])
-                else:
-                    return VpkFile(self.path_template % f[0], f[1], f[2])
-
-                return True
-        # if(self.filelist.get(path_ext)):
-        #     for f in self.filelist[path_ext]:
-        #         if(f[0].lower() == path_noext):
-        #             if(f[1] == 0x7fff):
-        #                 # Not supported right now
-        #                 return None
-        #                 # return VpkFile(self.path, f[5], f[4])
-        #             else:
-        #                 return VpkFile(self.path_template % f[1], f[2], f[3])
+        if(f.size == 0):
+            # Small files are stored entirely in the preload bytes
+            return self.dir_archive.open(self.dirtree_offset + f.preload_offset, f.preload_size)
 
-        return None
+        if(f.archive_index == VPK_EMBEDDED_ARCHIVE):
+            chunk, offset = self.dir_archive, self.embedded_offset + f.offset
+        else:
+            chunk, offset = self.get_chunk(f.archive_index), f.offset
 
-    def has_file(self, path):
-        path_noext = path[:path.rfind('.')].lower()
-        path_ext = path[path.rfind('.')+1:].lower()
-        if(self.filelist.get(path_ext)):
-            if(self.filelist[path_ext].get(path_noext)):
-                return True
-            # for f in self.filelist[path_ext]:
-            #     if(f[0].lower() == path_noext):
-            #         return True
+        if(f.preload_size == 0):
+            return chunk.open(offset, f.size)
+
+        preload = self.dir_archive.slice(self.dirtree_offset + f.preload_offset, f.preload_size)
+        return VpkFile(b''.join((preload, chunk.slice(offset, f.size))))
+
+    def get_crc(self, path):
+        return self.columns.crc[self.entries[path]]
+
+    def read_many(self, paths):
+        result = {}
+        reads = {}
+        for p in paths:
+            f = self.get_entry(p)
+            if(f.preload_size or f.size == 0):
+                result[p] = self.open_normalized(p).read()
+                continue
+
+            offset = f.offset + (self.embedded_offset if f.archive_index == VPK_EMBEDDED_ARCHIVE else 0)
+            reads.setdefault(f.archive_index, []).append((offset, f.size, p))
 
-        return False
+        for index, entries in reads.items():
+            chunk = self.get_chunk(index)
+            for run in coalesce_reads(entries):
+                start = run[0][0]
+                end = max(offset + size for offset, size, _ in run)
+                data = chunk.slice(start, end - start).tobytes()
+                for offset, size, p in run:
+                    result[p] = data[offset-start:offset-start+size]
+
+        return result
+
+    def get_chunk(self, index):
+        chunk = self.chunks.get(index)
+        if(chunk is None):
+            chunk = MappedArchive(self.path_template % index)
+            self.chunks[index] = chunk
+
+        return chunk
+
+    def close(self):
+        for c in self.chunks.values():
+            c.close()
+        self.chunks = {}
+
+    def has_file(self, path):
+        return normalize_path(path) in self.entries
 
     def fetch_filelist(self):
         if(self.dirtree_offset <= 0):
             raise Exception("Directory tree offset is zero")
 
-        self.filelist = {}
-        self.file.seek(self.dirtree_offset, False)
-        temp_data = self.file.f.read(self.dirtree_size)
-        br = BinaryReader(io.BytesIO(temp_data))
+        self.entries, self.columns = parse_dirtree(self.dir_archive.slice(self.dirtree_offset, self.dirtree_size).tobytes())
 
-        files = 0
-        start_time = time.time_ns()
-        while True:
-            extension = br.readString()
-            if(extension == ""):
-                break
+    def index_cache_path(self):
+        key = hashlib.sha1(os.path.abspath(self.path).encode('utf-8')).hexdigest()
+        return get_cache_path("vpk", key + ".idx")
 
-            # paths = []
-            paths = {}
-            while True:
-                path = br.readString()
-                if(path == ""):
-                    break
+    # Index cache layout:
+    # header ('4sIqqI': magic, format version, archive size, archive mtime, entry count), archive path length + path,
+    # NUL-separated entry paths in row order, then one column per VpkEntry field
+    def load_index_cache(self):
+        try:
+            stat = os.stat(self.path)
+            with open(self.index_cache_path(), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
 
-                while True:
-                    filename = br.readString()
-                    if(filename == ""):
-                        break
+        try:
+            magic, version, size, mtime, count = struct.unpack_from('<4sIqqI', data)
+            if((magic, version, size, mtime) != (INDEX_CACHE_MAGIC, INDEX_CACHE_VERSION, stat.st_size, stat.st_mtime_ns)):
+                return False
+
+            pos = struct.calcsize('<4sIqqI')
+            path_size = struct.unpack_from('<I', data, pos)[0]
+            pos += 4
+            if(data[pos:pos+path_size].decode('utf-8') != os.path.abspath(self.path)):
+                return False
+            pos += path_size
+
+            names_size = struct.unpack_from('<I', data, pos)[0]
+            pos += 4
+            names = data[pos:pos+names_size].decode('utf-8').split('\0') if count else []
+            pos += names_size
+
+            columns = []
+            for typecode in VPK_COLUMN_TYPECODES:
+                column = array(typecode)
+                column.frombytes(data[pos:pos + count * column.itemsize])
+                pos += count * column.itemsize
+                columns.append(column)
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return False
 
-                    # paths.append(os.path.join(path, filename))
-                    header = br.readt("IHHIIH")
-                    crc = header[0]
-                    preload_bytes = header[1]
-                    archive_index = header[2]
-                    entry_offset = header[3]
-                    entry_size = header[4]
-                    terminator = header[5]
-                    p = f"{path}/{filename}"
-                    paths[p] = (archive_index, entry_offset, entry_size)
-                    files += 1
-
-                    br.seek(preload_bytes)
-                    # print(f"\rFound {files} files", end='')
-
-                    # print(f"{p} | {archive_index}")
-
-            # TODO: Check for double entries and prevent original entries from being overwritten
-            if(self.filelist.get(extension)):
-                self.filelist[extension] += paths
-            else:
-                self.filelist[extension] = paths
-        # print(f" in {(time.time_ns()-start_time) / 1e+6}ms")
-        # print(f"found {files} files in {(time.time_ns()-start_time) / 1e+6}ms")
+        if(len(names) != count or any(len(c) != count for c in columns)):
+            return False
+
+        self.entries = dict(zip(names, range(count)))
+        self.columns = VpkEntry._make(columns)
+        return True
+
+    def save_index_cache(self):
+        stat = os.stat(self.path)
+        names = '\0'.join(self.entries.keys()).encode('utf-8')
+        path = os.path.abspath(self.path).encode('utf-8')
+
+        try:
+            with open(self.index_cache_path(), 'wb') as f:
+                f.write(struct.pack('<4sIqqI', INDEX_CACHE_MAGIC, INDEX_CACHE_VERSION, stat.st_size, stat.st_mtime_ns, len(self.entries)))
+                f.write(struct.pack('<I', len(path)) + path)
+                f.write(struct.pack('<I', len(names)) + names)
+                for c in self.columns:
+                    c.tofile(f)
+        except OSError as e:
+            print(f"[SourceSmoothie] Failed to write VPK index cache for '{self.path}': {e}")
+
+class ContentCache:
+    """LRU cache of entry contents with a byte budget, keyed by (normalized path, entry CRC)
+
+    Entries read from mapped archives are kept as views of the map, so they cost address space rather than copies
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.items = OrderedDict()
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if(data is None):
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if(len(data) > self.budget):
+                return
+
+            old = self.items.pop(key, None)
+            if(old is not None):
+                self.bytes_used -= len(old)
+
+            self.items[key] = data
+            self.bytes_used += len(data)
+            self.evict(self.budget)
+
+    def evict(self, budget):
+        while self.bytes_used > budget and self.items:
+            _, data = self.items.popitem(last=False)
+            self.bytes_used -= len(data)
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict(budget)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes_used = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.items),
+            'bytes': self.bytes_used,
+            'budget': self.budget,
+        }
+
+
+CONTENT_CACHE_BUDGET = 256 * 1024 * 1024
+content_cache = ContentCache(CONTENT_CACHE_BUDGET)
 
 mounted_archives = {}
 
@@ -218,21 +502,243 @@ def open_archive(path):
     else:
         raise Exception(f"Unsupported archive format '{ext}'")
 
+# Normalized path -> the highest precedence mounted archive containing it
+mounted_index = {}
+
+# Archives that were discovered but haven't been parsed yet, as (rank, path) in precedence order
+pending_archives = deque()
+
+# Lower ranks take precedence, every archive gets the next rank when it's mounted or queued
+next_rank = itertools.count()
+
+# Held while the index, the mounted archives or the pending queue change
+mount_lock = threading.RLock()
+
+# Paths (exactly as they were asked for) that aren't in any archive, so repeated misses cost a single set probe.
+# Cleared whenever an archive is mounted, mount_generation lets lookups that raced with a mount skip adding to it
+missing_paths = set()
+mount_generation = 0
+
 def mount(path):
-    if(mounted_archives.get(path)):
-        del mounted_archives[path]
+    mount_archive(path, open_archive(path))
+
+def mount_archive(path, arc, rank=None):
+    with mount_lock:
+        if(path in mounted_archives):
+            unmount(path)
+
+        arc.mount_rank = next(next_rank) if rank is None else rank
+        mounted_archives[path] = arc
+
+        global mount_generation
+        mount_generation += 1
+        missing_paths.clear()
+
+        # Claim every path nobody else has, and the ones held by archives with a lower precedence
+        for k in arc.entries.keys() & mounted_index.keys():
+            if(mounted_index[k].mount_rank > arc.mount_rank):
+                mounted_index[k] = arc
+        mounted_index.update(dict.fromkeys(arc.entries.keys() - mounted_index.keys(), arc))
+
+# Rank of the archive mounted with mount_override(), ahead of every regular mount
+OVERRIDE_RANK = -1
+
+def mount_override(path, arc):
+    """Mounts an archive with precedence over all others, like the pakfile of the map being imported. There's only
+    one at a time, mounting another one unmounts it"""
+    with mount_lock:
+        for p in [p for p, a in mounted_archives.items() if a.mount_rank == OVERRIDE_RANK and p != path]:
+            unmount(p)
+
+        mount_archive(path, arc, OVERRIDE_RANK)
+
+def open_archive_timed(path):
+    start = time.perf_counter()
+    try:
+        arc = open_archive(path)
+    except Exception as e:
+        return (None, e, time.perf_counter() - start)
+
+    return (arc, None, time.perf_counter() - start)
+
+def mount_many(paths, workers=None):
+    """Open archives on a thread pool and mount them in the order given, so precedence is the same as calling
+    `mount()` for every path one after another
+
+    Returns a (path, seconds, error) tuple for every archive, error is None if it mounted
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(open_archive_timed, paths))
+
+    timings = []
+    for path, (arc, error, elapsed) in zip(paths, results):
+        if(arc):
+            mount_archive(path, arc)
+        timings.append((path, elapsed, error))
+
+    return timings
+
+def mount_lazy(paths):
+    """Queue archives without reading them, each one is parsed the first time a lookup needs it (or by
+    `start_background_mounting()`). Precedence is the same as calling `mount()` for every path right away"""
+    with mount_lock:
+        for path in paths:
+            pending_archives.append((next(next_rank), path))
+
+def next_pending_rank():
+    try:
+        return pending_archives[0][0]
+    except IndexError:
+        return None
 
-    arc = open_archive(path)
-    mounted_archives[path] = arc
+def mount_next_pending():
+    with mount_lock:
+        if(not pending_archives):
+            return False
+
+        rank, path = pending_archives[0]
+        arc, error, elapsed = open_archive_timed(path)
+        if(arc):
+            mount_archive(path, arc, rank)
+            print(f"[SourceSmoothie] {elapsed * 1000:8.1f}ms | {path} (mounted on demand)")
+        else:
+            print(f"[SourceSmoothie] {'failed'.rjust(10)} | {path}: {error}")
+
+        # Only dequeue once the archive is in the index, lookups compare against the first pending rank
+        pending_archives.popleft()
+        return True
+
+def mount_all_pending():
+    while mount_next_pending():
+        pass
+
+mount_thread = None
+
+def start_background_mounting():
+    global mount_thread
+    mount_thread = threading.Thread(target=mount_all_pending, name="SourceSmoothie VPK mounting", daemon=True)
+    mount_thread.start()
+    return mount_thread
+
+def is_mounting():
+    """Whether archives are being mounted on the background thread (which holds mount_lock while it parses them)"""
+    return mount_thread is not None and mount_thread.is_alive()
+
+def unmount(path):
+    with mount_lock:
+        for p in [p for p in pending_archives if p[1] == path]:
+            pending_archives.remove(p)
+
+        arc = mounted_archives.pop(path, None)
+        if(arc is None):
+            return
+
+        for k in arc.entries.keys():
+            if(mounted_index.get(k) is arc):
+                del mounted_index[k]
+                other = min((o for o in mounted_archives.values() if k in o.entries), key=lambda o: o.mount_rank, default=None)
+                if(other):
+                    mounted_index[k] = other
+
+        arc.close()
+
+def find_archive(path):
+    """Highest precedence archive holding the (normalized) path, parsing pending archives until
+    none of them could take precedence over the result"""
+    arc = mounted_index.get(path)
+    while True:
+        rank = next_pending_rank()
+        if(rank is None or (arc is not None and arc.mount_rank < rank)):
+            return arc
+
+        mount_next_pending()
+        arc = mounted_index.get(path)
 
 def open_from_mounted(path):
-    fixed_path = path.replace('\\', '/').strip('\0\r\n\t')
-    for p, v in mounted_archives.items():
-        f = v.open_file(fixed_path)
-        if(f):
-            return f
-    
-    return None
+    if(path in missing_paths):
+        return None
+
+    generation = mount_generation
+    fixed_path = normalize_path(path)
+    arc = find_archive(fixed_path)
+    if(arc is None):
+        # Checked and added together, so a mount can't land in between and leave a stale miss behind
+        with mount_lock:
+            if(generation == mount_generation and not pending_archives):
+                missing_paths.add(path)
+        return None
+
+    key = (fixed_path, arc.get_crc(fixed_path))
+    data = content_cache.get(key)
+    if(data is not None):
+        return VpkFile(data)
+
+    f = open_uncached(arc, fixed_path)
+    if(f is None):
+        return None
+
+    data = f.getbuffer() if isinstance(f, VpkFile) else memoryview(f.read())
+    content_cache.put(key, data)
+    return VpkFile(data)
+
+def open_many(paths):
+    """Read a batch of files, returns ({path: bytes}, [paths that weren't found])
+
+    Every path is resolved first, then each archive reads its share grouped by chunk and sorted by offset, so
+    neighbouring entries come from one sequential read instead of a seek per file. Results go through the content cache
+    """
+    found = {}
+    missing = []
+    by_archive = {}
+    for path in dict.fromkeys(paths):
+        if(path in missing_paths):
+            missing.append(path)
+            continue
+
+        fixed_path = normalize_path(path)
+        arc = find_archive(fixed_path)
+        if(arc is None):
+            missing.append(path)
+            continue
+
+        key = (fixed_path, arc.get_crc(fixed_path))
+        data = content_cache.get(key)
+        if(data is not None):
+            found[path] = data.tobytes()
+        else:
+            by_archive.setdefault(arc, {}).setdefault(fixed_path, []).append((path, key))
+
+    for arc, requests in by_archive.items():
+        results = arc.read_many(requests.keys())
+        for fixed_path, requesters in requests.items():
+            data = results.get(fixed_path)
+            for path, key in requesters:
+                if(data is None):
+                    # Couldn't be read in bulk, go through the regular path (and its fallbacks)
+                    f = open_from_mounted(path)
+                    if(f is None):
+                        missing.append(path)
+                    else:
+                        found[path] = f.read()
+                else:
+                    found[path] = data
+                    content_cache.put(key, memoryview(data))
+
+    return found, missing
+
+def open_uncached(arc, fixed_path):
+    f = arc.open_normalized(fixed_path)
+    if(f is None):
+        # Entry exists but can't be opened (bad CRC, unsupported storage), try the archives below it
+        mount_all_pending()
+        with mount_lock:
+            for v in sorted(mounted_archives.values(), key=lambda a: a.mount_rank):
+                if(v is not arc and fixed_path in v.entries):
+                    f = v.open_normalized(fixed_path)
+                    if(f):
+                        break
+
+    return f
 
 # to_mount = [
 #    "/home/lucas/.steam/steam/steamapps/common/Team Fortress 2/tf/tf2_textures_dir.vpk",
@@ -1,5 +1,3 @@
-import bmesh
-import zipfile
 import bpy
 import time
 import numpy as np
@@ -9,12 +7,13 @@ import sys
 import traceback
 from collections import namedtuple
 
-from .bsp_data import (BspData, HU_SCALE_FACTOR)
-from bpy.props import (StringProperty, BoolProperty)
+from .bsp_data import (BspData, DECODED_LUMPS, PAKFILE_LUMP, HU_SCALE_FACTOR, parse_entities, index_brush_entities, parse_game_lumps, decode_static_props)
+from . import (bsp_catalog, bsp_geometry)
+from bpy.props import (StringProperty, BoolProperty, IntProperty, FloatProperty, FloatVectorProperty, EnumProperty)
 from bpy_extras.io_utils import (ImportHelper)
-from .vmt import (load_vmt, createNoneMaterial, createNoneTexture)
+from .vmt import (load_vmt, prefetch_materials, createNoneMaterial, createNoneTexture)
 from .mdl import (load_mdl)
-from ..shared.binhelper import (BinaryReader, try_decompress)
+from ..shared.binhelper import (BinaryReader, BufferFile, try_decompress)
 from ..shared import vpk
 from ..shared.utils import *
 
@@ -55,26 +54,6 @@ BspFace = namedtuple("BspFace", """
 """)
 ##
 
-def parse_entities(entitydata: str):
-    entities = []
-    lines = entitydata.splitlines()
-
-    for i in range(len(lines)):
-        if(lines[i].startswith('{')):
-            i += 1
-            entity = {}
-            while i < len(lines) and not lines[i].startswith('}'):
-                kv = [s for s in lines[i].split('"') if s != '' and s != ' ']
-                if(len(kv) == 2):
-                    entity[kv[0]] = kv[1]
-                i += 1
-
-            if('classname' in entity and 'origin' in entity):
-                entities.append(entity)
-    
-    return entities
-
-
 def angles_to_radians(angles):
     return [radians(x) for x in angles]
 
@@ -105,16 +84,6 @@ def parse_vector(s: str, default=[0,0,0], downscale=False):
         return default
 
 
-def calculate_uv(ti: BspTexInfo, td: BspTexData, vertex):
-    tu = (ti.uv0_0, ti.uv0_1, ti.uv0_2, ti.uv0_3)
-    tv = (ti.uv1_0, ti.uv1_1, ti.uv1_2, ti.uv1_3)
-
-    return (
-        (tu[0] * vertex[0] + tu[1] * vertex[1] + tu[2] * vertex[2] + tu[3]) / td.width,
-       -(tv[0] * vertex[0] + tv[1] * vertex[1] + tv[2] * vertex[2] + tv[3]) / td.height
-    )
-
-
 def createEmptyTexture():
     image = bpy.data.images.new(
         "NOTEXTURE",
@@ -145,36 +114,38 @@ def createEmptyMaterial(name, diffuse_colour=[1.0, 1.0, 1.0]):
     return m
 
 
-def parse_gamelump(data: bytes):
-    br = BinaryReader(BytesIO(data))
-    lump_count = br.read32()
-    return br.read_iterative(lump_count * 16, 'IHHII')
+def material_file_path(texstrdata: bytes, texstrtable, td: BspTexData):
+    texture_name_offset = texstrtable[td.name_table_id]
+    material_path = texstrdata[texture_name_offset:texstrdata.index(b'\0', texture_name_offset)].decode('ascii')
+    return material_path, "materials/" + (material_path if material_path[-4:].lower() == '.vmt' else material_path + ".vmt")
 
 
-def parse_static_props(data: bytes, lump_version):
-    br = BinaryReader(BytesIO(data))
-    name_entries = br.read32()
-    model_names = []
+def fill_mesh(mesh, vertices, loop_vertices, loop_starts, loop_totals, loop_uvs=None, material_indices=None, vertex_alpha=None):
+    """Fills an empty mesh from flat arrays in one go, instead of creating its elements one by one"""
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(vertices, np.float32).ravel())
 
-    for i in range(name_entries):
-        model_names.append(br.readString(128))
+    mesh.loops.add(len(loop_vertices))
+    mesh.loops.foreach_set("vertex_index", np.ascontiguousarray(loop_vertices, np.int32))
 
-    leaf_entries = br.read32()
-    br.seek(leaf_entries * 2) # Skip these, as we won't be using them
+    mesh.polygons.add(len(loop_starts))
+    mesh.polygons.foreach_set("loop_start", np.ascontiguousarray(loop_starts, np.int32))
+    mesh.polygons.foreach_set("loop_total", np.ascontiguousarray(loop_totals, np.int32))
+    if(material_indices is not None):
+        mesh.polygons.foreach_set("material_index", np.ascontiguousarray(material_indices, np.int32))
 
-    model_count = br.read32()
-    models = []
-    model_struct_size = (len(data) - br.f.tell()) // model_count
-    for i in range(model_count):
-        origin = br.readVec3()
-        angles = br.readVec3()
+    if(loop_uvs is not None):
+        uv_layer = mesh.uv_layers.new()
+        uv_layer.data.foreach_set("uv", np.ascontiguousarray(loop_uvs, np.float32).ravel())
 
-        name_index = br.read16()
+    if(vertex_alpha is not None):
+        # Displacement blend alpha, stored as a greyscale colour per loop
+        colors = np.ones((len(loop_vertices), 4), np.float32)
+        colors[:, :3] = np.asarray(vertex_alpha, np.float32)[loop_vertices, None]
+        color_layer = mesh.vertex_colors.new(name="alpha")
+        color_layer.data.foreach_set("color", colors.ravel())
 
-        br.seek(model_struct_size - 26)
-        models.append((model_names[name_index], origin, angles))
-    
-    return models
+    mesh.update(calc_edges=True)
 
 
 def create_obj(name):
@@ -201,228 +172,165 @@ class BspLoader(bpy.types.Operator, ImportHelper):
     # import_props: BoolProperty(name="Import props", default=True) 
     downscale: BoolProperty(name="Rescale map (recommended)", default=True)
     lock_objects: BoolProperty(name="Make objects unselectable", default=False)
+    chunk_polygons: IntProperty(
+        name="Polygons per chunk",
+        description="Split worldspawn into objects of roughly this many polygons on a uniform grid (0 keeps it as one object)",
+        default=0,
+        min=0,
+    )
+    use_cache: BoolProperty(name="Use parsed map cache", description="Keep the decoded map on disk so importing it again skips parsing", default=True)
+    region: EnumProperty(
+        name="Region",
+        description="Part of the map to import",
+        items=[
+            ('ALL', "Whole map", "Import the entire map"),
+            ('BOX', "Box", "Only import what overlaps the box between Region min and Region max"),
+            ('CURSOR', "Around 3D cursor", "Only import what overlaps the cube of Region radius around the 3D cursor"),
+        ],
+        default='ALL',
+    )
+    region_min: FloatVectorProperty(name="Region min", description="Lowest corner of the region box, in scene units", subtype='XYZ')
+    region_max: FloatVectorProperty(name="Region max", description="Highest corner of the region box, in scene units", subtype='XYZ')
+    region_radius: FloatProperty(name="Region radius", description="Half the size of the region around the 3D cursor, in scene units", default=10.0, min=0.0, subtype='DISTANCE')
 
 
     def execute(self, context):
-        self.file = BinaryReader(open(self.filepath, 'rb'))
+        self.region_bounds = self.get_region_bounds(context)
         if(not self.load()):
             return {'CANCELLED'}
 
         return {'FINISHED'}
 
 
+    def get_region_bounds(self, context):
+        """The region to import as a (mins, maxs) box in Source units, or None for the whole map"""
+        if(self.region == 'BOX'):
+            mins, maxs = np.minimum(self.region_min, self.region_max), np.maximum(self.region_min, self.region_max)
+        elif(self.region == 'CURSOR'):
+            cursor = np.array(context.scene.cursor.location)
+            mins, maxs = cursor - self.region_radius, cursor + self.region_radius
+        else:
+            return None
+
+        # Imported objects are scaled down, the region is given in the units they end up in
+        scale = HU_SCALE_FACTOR if self.downscale else 1.0
+        return mins / scale, maxs / scale
+
+
     def load(self):
         self.sb = start_bench("Load BSP")
+        # The stats printed at the end are for this import only
+        vpk.content_cache.reset_stats()
         b = start_bench("Read data")
-        self.data = BspData(self.file, self.downscale)
-        if(not self.data.read()):
-            return False
+        # Lumps are read from the mapped file as they're needed
+        # The pakfile is often the largest compressed lump, so it's decompressed along with the others
+        extra_lumps = [PAKFILE_LUMP] if(self.import_materials) else []
+        if(self.use_cache):
+            self.data = BspData.open_cached(self.filepath, self.downscale, extra_lumps)
+        else:
+            self.data = BspData.open_mapped(self.filepath, self.downscale)
+            self.data.decompress_lumps(DECODED_LUMPS + extra_lumps)
+        if(self.import_materials):
+            self.data.mount_pakfile()
         end_bench(b)
 
         self.collection = bpy.data.collections.new(bpy.path.display_name_from_filepath(self.filepath))
         bpy.context.scene.collection.children.link(self.collection)
 
-        return self.build_mesh()
+        try:
+            return self.build_mesh()
+        finally:
+            self.data.unmount_pakfile()
+
+
+    def load_model_materials(self, ob, texdata_indices, material_files: dict, global_material_cache: dict):
+        """Adds the materials of the given texdata entries to the object, returns an array of texdata -> material slot (-1 for none)"""
+        slots = np.full(len(self.data.texdata), -1, np.int64)
+        for texdata_index in texdata_indices:
+            if(texdata_index not in global_material_cache):
+                td = self.data.texdata[texdata_index]
+                material_path, material_path_withext = material_file_path(self.data.texstrdata, self.data.texstrtable, td)
+                material_data = material_files.get(material_path_withext)
+                if(material_data is not None):
+                    global_material_cache[texdata_index] = load_vmt(BytesIO(material_data), material_path, [td.reflectivity_r, td.reflectivity_g, td.reflectivity_b, 1.0])
+                else:
+                    print(f"Failed to open material file '{material_path_withext}'")
+                    global_material_cache[texdata_index] = None
+
+            if(global_material_cache[texdata_index] is not None):
+                ob.data.materials.append(global_material_cache[texdata_index])
+                slots[texdata_index] = len(ob.data.materials) - 1
+
+        return slots
 
 
     def build_mesh(self):
         b = start_bench("Build mesh")
 
-        current_texture_index = 0
-        global_material_cache = {}
-        for mi, m in enumerate(self.data.models):
+        # Worldspawn is narrowed down to the faces in the region, brush entities are only imported if they overlap it
+        imported_faces = {}
+        for mi in range(len(self.data.models)):
             if(mi != 0 and mi not in self.data.model_origins):
                 continue
-            bm = bmesh.new()
-            if(mi == 0):
-                ob = create_obj(f"worldspawn")
-            else:
-                ob = create_obj(f"model ({mi})")
-
-            update_bench(b, f"{mi+1}/{len(self.data.models)}")
-            material_cache = {}
-            for f in self.data.faces[m.first_face : m.first_face+m.face_count]:
-                ti = self.data.texinfo[f.texinfo]
-                td = self.data.texdata[ti.texdata]
-                if(ti.flags & 0x2c0):
-                    continue
 
-                # TODO: Copied from quake 3 bsp loader, needs to be rewritten and moved to it's own task (benchmark)
-                material_id = -1
-                if self.import_materials:
-                    texture_name_offset = self.data.texstrtable[td.name_table_id]
-                    material_path = self.data.texstrdata[texture_name_offset:self.data.texstrdata.index(b'\0', texture_name_offset)].decode('ascii')
-                    if(ti.texdata in material_cache):
-                        material_id = material_cache[ti.texdata][1]
-                    elif(ti.texdata in global_material_cache):
-                        ob.data.materials.append(global_material_cache[ti.texdata])
-                        material_id = len(ob.data.materials) - 1
-                        material_cache[ti.texdata] = (global_material_cache[ti.texdata], material_id)
-                    else:
-                        # TODO: Fix the progress indicator
-                        update_bench(b, f"{mi+1}/{len(self.data.models)}, texture {current_texture_index}/{len(self.data.texdata)}")
-                        material_path_withext = material_path if material_path[-4:].lower() == '.vmt' else material_path + ".vmt"
-                        material_file = vpk.open_from_mounted("materials/" + material_path_withext)
-                    
-                        if(material_file):
-                            imported_material = load_vmt(material_file, material_path, [td.reflectivity_r, td.reflectivity_g, td.reflectivity_b, 1.0])
-                            ob.data.materials.append(imported_material)
-                            material_id = len(ob.data.materials) - 1
-                            global_material_cache[ti.texdata] = imported_material
-                            material_cache[ti.texdata] = (imported_material, material_id)
-                            current_texture_index += 1
-                        else:
-                            print(f"Failed to open material file '{material_path_withext}'")
-                            global_material_cache[ti.texdata] = None
-                            material_cache[ti.texdata] = (None, -1)
-                            current_texture_index += 1
-
-                if(f.dispinfo != -1):
-                    di = self.data.displacementinfo[f.dispinfo]
-                    low_base = (di.start_x, di.start_y, di.start_z)
-                    if(f.edge_count != 4):
-                        print(f"Bad displacement (face #{i})")
-                        continue
-
-                    corner_verts = list()
-                    corner_indices = list()
-                    base_dist = np.inf
-                    base_index = -1
-                    for k in range(4):
-                        ei = self.data.surfedges[f.first_edge+k]
-                        vi = self.data.edges[-ei if ei < 0 else ei][1 if ei < 0 else 0]
-
-                        corner_verts.append(self.data.vertices[vi])
-                        corner_indices.append(vi)
-                        this_dist = abs(corner_verts[k][0] - low_base[0]) + abs(corner_verts[k][1] - low_base[1]) + abs(corner_verts[k][2] - low_base[2])
-                        if(this_dist < base_dist):
-                            base_dist = this_dist
-                            base_index = k
-                    
-                    if(base_index == -1):
-                        print(f"Bad base in displacement #{i}")
-                        continue
+            if(self.region_bounds is None):
+                imported_faces[mi] = bsp_geometry.model_faces(self.data, mi)
+            elif(mi == 0):
+                imported_faces[mi] = bsp_geometry.model_faces(self.data, mi, self.region_bounds)
+            elif(bsp_geometry.model_in_box(self.data, mi, *self.region_bounds)):
+                imported_faces[mi] = bsp_geometry.model_faces(self.data, mi)
 
-                    high_base = corner_verts[(base_index+3) % 4]
-                    high_ray = np.subtract(corner_verts[(base_index+2) % 4], high_base)
-                    low_ray = np.subtract(corner_verts[(base_index+1) % 4], low_base)
+        global_material_cache = {}
+        material_files = {}
+        if self.import_materials:
+            # Only the materials of the faces that are imported, which is a lot less than the whole map for a small region
+            used_faces = np.concatenate([np.zeros(0, np.int64)] + [faces for both in imported_faces.values() for faces in both])
+            used_texdata = np.unique(self.data.texinfo.texdata[self.data.faces.texinfo[used_faces]]).tolist()
+            material_files = prefetch_materials([material_file_path(self.data.texstrdata, self.data.texstrtable, self.data.texdata[tdi])[1] for tdi in used_texdata])
+
+        for mi, (brush_faces, displacement_faces) in imported_faces.items():
+            if(self.region_bounds is not None and len(brush_faces) + len(displacement_faces) == 0):
+                continue
 
-                    verts_wide = (2 << (di.power - 1)) + 1
-                    base_verts = []
-                    base_dispvert_index = di.disp_vert_start
-                    if(base_dispvert_index < 0):
-                        base_dispvert_index = abs(base_dispvert_index)
-                    
-                    for y in range(verts_wide):
-                        fy = y / (verts_wide-1)
-                        mid_base = np.add(low_base, np.multiply(low_ray, fy))
-                        mid_ray = np.subtract(np.add(high_base, np.multiply(high_ray, fy)), mid_base)
+            update_bench(b, f"{mi+1}/{len(self.data.models)}")
+            brush = bsp_geometry.build_brush_mesh(self.data, brush_faces)
+            mesh = bsp_geometry.merge_meshes([brush, bsp_geometry.build_displacement_mesh(self.data, displacement_faces)])
+            mesh = bsp_geometry.remove_invalid_faces(mesh)
 
-                        for x in range(verts_wide):
-                            fx = x / (verts_wide - 1)
-                            i = x + y * verts_wide
-                            
-                            dv = self.data.displacement_verts[base_dispvert_index+i]
-                            offset = (dv.vx, dv.vy, dv.vz)
-                            scale = dv.dist
+            if(mi == 0 and self.chunk_polygons > 0):
+                parts = [(f"worldspawn ({ci})", chunk) for ci, chunk in enumerate(bsp_geometry.split_into_chunks(mesh, self.chunk_polygons))]
+            else:
+                parts = [("worldspawn" if mi == 0 else f"model ({mi})", mesh)]
 
-                            base_verts.append(np.add(np.add(mid_base, np.multiply(mid_ray, fx)), np.multiply(offset, scale)))
+            for name, part in parts:
+                ob = create_obj(name)
+                material_slots = np.full(len(self.data.texdata), -1, np.int64)
+                if self.import_materials:
+                    material_slots = self.load_model_materials(ob, np.unique(part.face_texdata).tolist(), material_files, global_material_cache)
 
+                fill_mesh(
+                    ob.data, part.vertices, part.loop_vertices, part.loop_starts, part.loop_totals, part.loop_uvs,
+                    np.maximum(material_slots[part.face_texdata], 0),
+                    part.vertex_alpha if(len(displacement_faces) > 0) else None
+                )
 
-                    for y in range(verts_wide-1):
-                        for x in range(verts_wide-1):
-                            i = x + y * verts_wide
+                if(mi != 0):
+                    origin = self.data.model_origins[mi]
+                    ob.location = origin[0]
+                    ob.rotation_euler = angles_to_radians((origin[1][2], origin[1][0], origin[1][1]))
 
-                            face = [
-                                bm.verts.new(base_verts[i]),
-                                bm.verts.new(base_verts[i+1]),
-                                bm.verts.new(base_verts[i+verts_wide+1]),
-                                bm.verts.new(base_verts[i+verts_wide])
-                            ]
-
-                            bface = 0
-                            try:
-                                bface = bm.faces.new(face)
-                            except Exception as e:
-                                # Skip duplicates (why is bmesh so rude..)
-                                continue
-                
-                            if(bface != 0):
-                                uv_layer = bm.loops.layers.uv.verify()
-                                bm.faces.ensure_lookup_table()
-
-                                face = bm.faces[-1]
-                                for loopElement in face.loops:
-                                    luvLayer = loopElement[uv_layer]
-                                    vertex = loopElement.vert.co
-
-                                    tu = (ti.uv0_0, ti.uv0_1, ti.uv0_2, ti.uv0_3)
-                                    tv = (ti.uv1_0, ti.uv1_1, ti.uv1_2, ti.uv1_3)
-                                    try:
-                                        luvLayer.uv[0] =  (vertex.dot(tu) + ti.uv0_3) / td.width
-                                        luvLayer.uv[1] = -(vertex.dot(tv) + ti.uv1_3) / td.height
-                                    except Exception as e:
-                                        pass
-
-                                if(material_id >= 0):
-                                    face.material_index = material_id
-                else:
-                    face = []
-                    for ei in range(f.edge_count):
-                        surfedge = self.data.surfedges[f.first_edge + ei]
-                        vi = self.data.edges[abs(surfedge)][1 if surfedge < 0 else 0]
-                        # face.append(bm.verts[vi])
-                        face.append(bm.verts.new(self.data.vertices[vi]))
+                if(self.downscale):
+                    ob.scale *= HU_SCALE_FACTOR
 
-                    face.reverse()
-                    bface = 0
-                    try:
-                        bface = bm.faces.new(face)
-                    except:
-                        # Skip duplicates (why is bmesh so rude..)
-                        continue
+                if(self.lock_objects):
+                    ob.hide_select = True
 
-                
-                    if(bface != 0):
-                        uv_layer = bm.loops.layers.uv.verify()
-                        bm.faces.ensure_lookup_table()
-
-                        face = bm.faces[-1]
-                        for loopElement in face.loops:
-                            luvLayer = loopElement[uv_layer]
-                            vertex = loopElement.vert.co
-
-                            tu = (ti.uv0_0, ti.uv0_1, ti.uv0_2, ti.uv0_3)
-                            tv = (ti.uv1_0, ti.uv1_1, ti.uv1_2, ti.uv1_3)
-                            try:
-                                luvLayer.uv[0] =  (vertex.dot(tu) + ti.uv0_3) / td.width
-                                luvLayer.uv[1] = -(vertex.dot(tv) + ti.uv1_3) / td.height
-                            except Exception as e:
-                                pass
-
-                        if(material_id >= 0):
-                            face.material_index = material_id
-            
-            if(mi != 0):
-                origin = self.data.model_origins[mi]
-                ob.location = origin[0]
-                ob.rotation_euler = angles_to_radians((origin[1][2], origin[1][0], origin[1][1]))
-
-            if(self.downscale):
-                ob.scale *= HU_SCALE_FACTOR
-            
-            if(self.lock_objects):
-                ob.hide_select = True
-
-            bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.001) # Distance value might need some tweaking
-
-            bm.to_mesh(ob.data)
-            bm.free()
-            self.collection.objects.link(ob)
+                self.collection.objects.link(ob)
 
         end_bench(b)
 
         end_bench(self.sb)
+        print(f"[SourceSmoothie] File cache: {vpk.content_cache.stats()}")
         
         return True
 
@@ -464,15 +372,9 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
 
         b = start_bench("Read entities")
         self.file.seek(self.lumps[0].offset, False)
-        entitydata = try_decompress(self.file.f.read(self.lumps[0].size)).decode('ascii')
-        open("entities.kv", 'w').write(entitydata)
+        entitydata = try_decompress(self.file.f.read(self.lumps[0].size)).decode('ascii', errors='replace')
         entities = parse_entities(entitydata)
-        entity_origins = {}
-        for e in entities:
-            if(e.get('model') and e['model'][0] == "*"):
-                index = int(e['model'][1:])
-                origin = parse_vector(e['origin'])
-                entity_origins[index] = origin
+        entity_origins = {index: parse_vector(e.get('origin', '0 0 0')) for index, e in index_brush_entities(entities).items()}
 
         end_bench(b)
 
@@ -531,21 +433,23 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
         # Game lump
         b = start_bench("Read game lump")
         self.file.seek(self.lumps[35].offset, False)
-        game_lump = parse_gamelump(self.file.f.read(self.lumps[35].size))
+        game_lumps = parse_game_lumps(self.file.f.read(self.lumps[35].size))
         static_props = []
-        for gl in game_lump:
-            if(gl[0] == 0x73707270):
-                self.file.seek(gl[3], False)
-                static_props = parse_static_props(try_decompress(self.file.f.read(gl[4])), gl[2])
-                break
+        if('sprp' in game_lumps):
+            gl = game_lumps['sprp']
+            self.file.seek(gl.offset, False)
+            sprp = decode_static_props(try_decompress(self.file.f.read(gl.size)), gl.version)
+            static_props = [
+                (sprp.models[prop_type], origin, angles)
+                for prop_type, origin, angles in zip(sprp.props.prop_type.tolist(), sprp.props.origin.tolist(), sprp.props.angles.tolist())
+            ]
         end_bench(b)
 
         b = start_bench("Read pakfile")
         self.file.seek(self.lumps[40].offset, False)
         pakdata = try_decompress(self.file.f.read(self.lumps[40].size))
-        open("pak.zip", 'wb').write(pakdata)
-        pakfile = zipfile.ZipFile("pak.zip")
-        vpk.mount("pak.zip")
+        pakfile_name = f"pakfile:{self.filepath}"
+        vpk.mount_override(pakfile_name, vpk.ZipWrapper(pakfile_name, pakdata))
         end_bench(b)
 
         # Texture string data
@@ -564,13 +468,11 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
         processed_faces = []
         processed_verts = []
         processed_textureindices = []
-        texture_coordinates = []
         stripped_faces = []
         hasbeentouched = [False] * len(verts)
 
         displacement_finishedverts = []
         displacement_faces = []
-        displacement_texture_coordinates = []
         displacement_textureindices = []
         displacement_indices = []
         displacement_facecolours = []
@@ -617,7 +519,7 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
                             base_index = k
                     
                     if(base_index == -1):
-                        print(f"Bad base in displacement #{i}")
+                        print(f"Bad base in displacement #{fi}")
                         continue
 
                     high_base = corner_verts[(base_index+3) % 4]
@@ -655,13 +557,6 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
                             displacement_finishedverts.append(base_verts[i+verts_wide])
                             displacement_finishedverts.append(base_verts[i+verts_wide+1])
 
-                            displacement_texture_coordinates.append((
-                                calculate_uv(texinfo[f.texinfo], td, base_verts[i]),
-                                calculate_uv(texinfo[f.texinfo], td, base_verts[i+1]),
-                                calculate_uv(texinfo[f.texinfo], td, base_verts[i+verts_wide]),
-                                calculate_uv(texinfo[f.texinfo], td, base_verts[i+verts_wide+1]),
-                            ))
-
                             displacement_textureindices.append(texinfo[f.texinfo].texdata)
                             displacement_faces.append(f)
 
@@ -690,12 +585,10 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
                     stripped_faces.append(f)
                     processed_textureindices.append(texinfo[f.texinfo].texdata)
                     face = []
-                    texcoord = []
                     faceverts = []
                     for ei in range(f.edge_count):
                         surfedge = surfedges[f.first_edge + ei]
                         vi = edges[abs(surfedge)][1 if surfedge < 0 else 0]
-                        texcoord.append(calculate_uv(ti, td, original_verts[vi]))
                         if(not hasbeentouched[vi]):
                             v = verts[vi]
                             nv = (
@@ -707,9 +600,7 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
                             hasbeentouched[vi] = True
                         face.append(vi)
 
-                    texcoord.reverse()
                     face.reverse()
-                    texture_coordinates.append(tuple(texcoord))
                     processed_verts.append(tuple(faceverts))
                     processed_faces.append(tuple(face))
 
@@ -790,6 +681,7 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
             collection.children.link(model_collection)
             duplicate_cache = {}
             model_cache = {}
+            model_files, _ = vpk.open_many([p[0].replace('mdl', ext) for p in static_props for ext in ('mdl', 'vvd', 'dx90.vtx')])
             for i, p in enumerate(static_props):
                 pobj = bpy.data.objects.new(f"static prop #{i} ({p[0]})", None)
                 pobj['model_path'] = p[0]
@@ -806,9 +698,10 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
                         duplicate_cache[i] = p
                     else:
 
-                        mdl_file = BinaryReader(vpk.open_from_mounted(p[0]))
-                        vvd_file = BinaryReader(vpk.open_from_mounted(p[0].replace('mdl', 'vvd')))
-                        vtx_file = BinaryReader(vpk.open_from_mounted(p[0].replace('mdl', 'dx90.vtx')))
+                        mdl_file, vvd_file, vtx_file = [
+                            BinaryReader(BufferFile(model_files[path]) if path in model_files else None)
+                            for path in (p[0].replace('mdl', ext) for ext in ('mdl', 'vvd', 'dx90.vtx'))
+                        ]
                         if(not mdl_file.is_valid):
                             print("Failed to load model: MDL file not found")
                             continue
@@ -858,22 +751,22 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
         end_bench(b)
 
         b = start_bench("Import materials")
+        material_files = {}
+        if(self.import_textures):
+            material_files = prefetch_materials([material_file_path(tex_stringdata, tex_stringtable, td)[1] for td in texdata])
         for i, td in enumerate(texdata):
             usefilter = False
             # td = texdata[ti.texdata]
-            texture_name_offset = tex_stringtable[td.name_table_id]
-            material_path = tex_stringdata[texture_name_offset:tex_stringdata.index(b'\0', texture_name_offset)].decode('ascii')
+            material_path, material_path_withext = material_file_path(tex_stringdata, tex_stringtable, td)
             update_bench(b, f"{i+1}/{len(texdata)}")
             if(self.import_textures):
-                # Hack-ish
-                material_path_withext = material_path if material_path[-4:].lower() == '.vmt' else material_path + ".vmt"
-                material_file = vpk.open_from_mounted("materials/" + material_path_withext)
+                material_data = material_files.get(material_path_withext)
 
-                if(not material_file):
+                if(material_data is None):
                     print(f"Material '{material_path}' not found in mounted archives")
                     imported_material = createNoneMaterial(material_path)
                 else:
-                    imported_material = load_vmt(material_file, material_path, diffuse_colour=[sqrt(td.reflectivity_r), sqrt(td.reflectivity_g), sqrt(td.reflectivity_b), 1.0])
+                    imported_material = load_vmt(BytesIO(material_data), material_path, diffuse_colour=[sqrt(td.reflectivity_r), sqrt(td.reflectivity_g), sqrt(td.reflectivity_b), 1.0])
             else:
                 imported_material = createEmptyMaterial(material_path, diffuse_colour=[sqrt(td.reflectivity_r), sqrt(td.reflectivity_g), sqrt(td.reflectivity_b), 1.0])
 
@@ -881,27 +774,24 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
         end_bench(b)
 
         b = start_bench("Apply texture coordinates")
-        if(mesh.is_editmode):
-            bm = bmesh.from_edit_mesh(mesh)
-        else:
-            bm = bmesh.new()
-            bm.from_mesh(mesh)
-
-        uv_layer = bm.loops.layers.uv.verify()
-        for i, face in enumerate(bm.faces):
-            ti = texinfo[faces[i].texinfo]
-            td = texdata[ti.texdata]
-            start_edge = faces[i].first_edge
-
-            uv_face = texture_coordinates[i]
-            for li, loop in enumerate(face.loops):
-                loop[uv_layer].uv = uv_face[li]
-        
-        if bm.is_wrapped:
-            bmesh.update_edit_mesh(me, False, False)
-        else:
-            bm.to_mesh(mesh)
-            mesh.update()
+        # Texture vectors and sizes of every texinfo entry, gathered per loop below so all UVs are projected at once
+        texinfo_s = np.array([(ti.uv0_0, ti.uv0_1, ti.uv0_2, ti.uv0_3) for ti in texinfo], np.float32).reshape(-1, 4)
+        texinfo_t = np.array([(ti.uv1_0, ti.uv1_1, ti.uv1_2, ti.uv1_3) for ti in texinfo], np.float32).reshape(-1, 4)
+        texinfo_size = np.array([(texdata[ti.texdata].width, texdata[ti.texdata].height) for ti in texinfo], np.float32).reshape(-1, 2)
+
+        def project(positions, loop_texinfo):
+            return bsp_geometry.project_uvs(positions, texinfo_s[loop_texinfo], texinfo_t[loop_texinfo], texinfo_size[loop_texinfo, 0], texinfo_size[loop_texinfo, 1])
+
+        # Faces were created from processed_faces, so their loops are those vertex lists back to back
+        loop_vertices = np.array([vi for face in processed_faces for vi in face], np.int64)
+        loop_texinfo = np.repeat(np.array([f.texinfo for f in stripped_faces], np.int64), [len(face) for face in processed_faces])
+        uvs = project(np.asarray(original_verts, np.float32).reshape(-1, 3)[loop_vertices], loop_texinfo)
+        mesh.uv_layers.new().data.foreach_set("uv", uvs.ravel())
+
+        # Displacement quads have 4 vertices of their own each, so the UVs are computed per vertex and then gathered per loop
+        vertex_texinfo = np.repeat(np.array([f.texinfo for f in displacement_faces], np.int64), 4)
+        vertex_uvs = project(np.asarray(displacement_finishedverts, np.float32).reshape(-1, 3), vertex_texinfo)
+        dmesh.uv_layers.new().data.foreach_set("uv", vertex_uvs[np.asarray(displacement_indices, np.int64).ravel()].ravel())
         end_bench(b)
 
         b = start_bench("Assign materials")
@@ -925,6 +815,7 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
             ob.data.polygons[i].material_index = tdi
 
         end_bench(b)
+        vpk.unmount(pakfile_name)
 
         print('-' * (64 + 3))
 
@@ -933,18 +824,45 @@ class BspLoaderOld(bpy.types.Operator, ImportHelper):
         return True
 
 
+class BspCatalogScanner(bpy.types.Operator):
+    """Catalog every BSP map in a directory without importing them"""
+    bl_idname = "sourcesmoothie.source1_bsp_catalog"
+    bl_description = "Scan a directory of Source 1 BSP files for their bounds, textures, props and entities"
+    bl_label = "Catalog Source 1 BSP directory"
+
+    directory: StringProperty(subtype="DIR_PATH")
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        b = start_bench("Catalog maps")
+        maps, scanned = bsp_catalog.scan_directory(self.directory)
+        end_bench(b)
+
+        failed = [path for path, info in maps.items() if "error" in info]
+        for path in failed:
+            print(f"[SourceSmoothie] Couldn't catalog {path}: {maps[path]['error']}")
+        self.report({'INFO'}, f"Cataloged {len(maps)} maps ({scanned} scanned, {len(failed)} failed), index at {bsp_catalog.default_index_path(self.directory)}")
+        return {'FINISHED'}
+
+
 def menu_import(self, context):
     self.layout.operator(BspLoader.bl_idname, text='Source 1 BSP (.bsp)')
     self.layout.operator(BspLoaderOld.bl_idname, text='Source 1 BSP (.bsp) (DEPRECATED IMPORTER')
+    self.layout.operator(BspCatalogScanner.bl_idname, text='Source 1 BSP catalog (directory)')
 
 
 def register():
     bpy.utils.register_class(BspLoaderOld)
     bpy.utils.register_class(BspLoader)
+    bpy.utils.register_class(BspCatalogScanner)
     bpy.types.TOPBAR_MT_file_import.append(menu_import)
 
 
 def unregister():
     bpy.types.TOPBAR_MT_file_import.remove(menu_import)
+    bpy.utils.unregister_class(BspCatalogScanner)
     bpy.utils.unregister_class(BspLoader)
     bpy.utils.unregister_class(BspLoaderOld)
@@ -0,0 +1,127 @@
+"""Catalog of BSP maps, built from the lump directory and a handful of small lumps without importing anything
+
+Doesn't depend on bpy, so scans can run in worker processes
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import multiprocessing
+import os
+from .bsp_data import BspData
+from ..shared.utils import get_cache_path
+from ..shared import vpk
+
+CATALOG_VERSION = 1
+
+
+def catalog_map(path: str):
+    """Collects bounds, textures, static prop models, entity counts and the pakfile size of a single map"""
+    data = BspData.open_mapped(path, downscale=False)
+    world = data.models[0] if len(data.models) > 0 else None
+    return {
+        "version": data.version,
+        "bounds": [
+            [float(world.min_x), float(world.min_y), float(world.min_z)],
+            [float(world.max_x), float(world.max_y), float(world.max_z)],
+        ] if world is not None else None,
+        "textures": sorted(set(data.texture_names)),
+        "static_props": data.static_prop_models,
+        "entity_count": len(data.entities),
+        "entity_classes": {classname: len(entities) for classname, entities in data.entities_by_classname.items()},
+        "pakfile_size": data.lumps[40].size,
+    }
+
+
+def catalog_map_safe(path: str):
+    try:
+        return catalog_map(path), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def default_index_path(directory: str):
+    return get_cache_path("catalog", hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest() + ".json")
+
+
+def load_index(index_path: str):
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if(index.get("version") == CATALOG_VERSION):
+            return index["maps"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    return {}
+
+
+def save_index(index_path: str, maps: dict):
+    temp_path = index_path + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({"version": CATALOG_VERSION, "maps": maps}, f, separators=(',', ':'))
+    os.replace(temp_path, index_path)
+
+
+def find_maps(directory: str):
+    """Relative path -> (size, mtime in ns) of every .bsp below `directory`"""
+    maps = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if(name.lower().endswith(".bsp")):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                maps[os.path.relpath(path, directory).replace('\\', '/')] = (stat.st_size, stat.st_mtime_ns)
+
+    return maps
+
+
+def run_pool(paths: list, workers=None, use_processes=True):
+    # Spawned workers would start another Blender instead of a plain interpreter, so processes are only used with fork
+    if(use_processes and multiprocessing.get_start_method() == 'fork'):
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(catalog_map_safe, paths, chunksize=8))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"[SourceSmoothie] Process pool failed ({e}), scanning on threads instead")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(catalog_map_safe, paths))
+
+
+def scan_directory(directory: str, index_path=None, workers=None, use_processes=None):
+    """Catalogs every map below `directory` and stores the results in a compact JSON index
+
+    Maps whose size and modification time haven't changed since the last scan are taken from the existing index,
+    maps that no longer exist are dropped from it. Returns (maps, number of maps that were (re)scanned)
+
+    By default worker processes are only used while no VPKs are being mounted in the background, a process forked while
+    the mount thread holds its lock would never see it released
+    """
+    if(use_processes is None):
+        use_processes = not vpk.is_mounting()
+
+    index_path = index_path or default_index_path(directory)
+    previous = load_index(index_path)
+
+    maps = {}
+    stale = []
+    for relpath, (size, mtime) in find_maps(directory).items():
+        entry = previous.get(relpath)
+        if(entry and entry["size"] == size and entry["mtime"] == mtime):
+            maps[relpath] = entry
+        else:
+            maps[relpath] = {"size": size, "mtime": mtime}
+            stale.append(relpath)
+
+    results = run_pool([os.path.join(directory, p) for p in stale], workers, use_processes)
+    for relpath, (info, error) in zip(stale, results):
+        if(error):
+            maps[relpath]["error"] = error
+        else:
+            maps[relpath].update(info)
+
+    if(len(stale) > 0 or len(maps) != len(previous)):
+        save_index(index_path, maps)
+
+    return maps, len(stale)
@@ -1,9 +1,19 @@
 from collections import namedtuple
-from ..shared.binhelper import BinaryReader, try_decompress
-from ..shared import vpk
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
 import zipfile
+import numpy as np
+from ..shared.binhelper import BinaryReader, BufferFile, try_decompress, lzma_header, unpack_named, LZMA_HEADER_SIZE
+from ..shared.utils import cached_property, get_cache_path
+from ..shared import vpk
 
 BspLump = namedtuple("BspLump", "offset size version uncompressed_size")
+BspGameLump = namedtuple("BspGameLump", "id flags version offset size")
 BspModel = namedtuple("BspModel", "min_x min_y min_z max_x max_y max_z origin_x origin_y origin_z head_node first_face face_count")
 BspTexData = namedtuple("BspTexData", "reflectivity_r reflectivity_g reflectivity_b name_table_id width height vwidth vheight")
 BspDisplacementInfo = namedtuple("BspDisplacementInfo", "start_x start_y start_z disp_vert_start disp_tri_start power min_tess smoothing_angle contents map_face lm_alpha_statr lm_sample_start u0 u1 u2 u3 u4 u5 u6 u7 u8 u9 u10 u11 u12 u13 u14 u15")
@@ -15,7 +25,7 @@ BspTexInfo = namedtuple("BspTexInfo", """
     luv0_0 luv0_1 luv0_2 luv0_3 
     luv1_0 luv1_1 luv1_2 luv1_3
 
-    flags
+    surface_flags
     texdata
 """)
 BspFace = namedtuple("BspFace", """
@@ -38,29 +48,220 @@ BspFace = namedtuple("BspFace", """
     smoothing_groups
 """)
 
+STRUCT_TO_NUMPY = {
+    'b': np.int8, 'B': np.uint8,
+    'h': np.int16, 'H': np.uint16,
+    'i': np.int32, 'I': np.uint32,
+    'q': np.int64, 'Q': np.uint64,
+    'f': np.float32, 'd': np.float64,
+}
+
+def make_dtype(nt: namedtuple, packing: str):
+    """Builds a structured dtype with the fields of `nt` and the (natively aligned) layout of a struct packing string"""
+    types = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z])', packing):
+        types += [STRUCT_TO_NUMPY[code]] * int(count or 1)
+
+    dtype = np.dtype(list(zip(nt._fields, types)), align=True)
+    assert dtype.itemsize == struct.calcsize(packing), f"{nt.__name__} dtype doesn't match '{packing}'"
+    return dtype
+
+BSP_MODEL_DTYPE = make_dtype(BspModel, '3f3f3fIII')
+BSP_TEXDATA_DTYPE = make_dtype(BspTexData, '3fI2I2I')
+BSP_DISPLACEMENT_INFO_DTYPE = make_dtype(BspDisplacementInfo, '3fiiiifiHii11Q5Q')
+BSP_DISPLACEMENT_VERT_DTYPE = make_dtype(BspDisplacementVert, '3fff')
+BSP_TEXINFO_DTYPE = make_dtype(BspTexInfo, '8f8fII')
+BSP_FACE_DTYPE = make_dtype(BspFace, 'HBBIhhhh4BIfIIIIIHHI')
+
+# Node tree records, negative children are leafs (-1 - leaf index). Bounds are in Source units, rounded outwards
+BSP_NODE_DTYPE = np.dtype([
+    ('plane_num', 'i4'), ('children', '2i4'),
+    ('mins', '3i2'), ('maxs', '3i2'),
+    ('first_face', 'u2'), ('face_count', 'u2'),
+    ('area', 'i2'), ('padding', 'i2'),
+], align=True)
+
+BSP_LEAF_FIELDS = [
+    ('contents', 'i4'), ('cluster', 'i2'), ('area_flags', 'i2'),
+    ('mins', '3i2'), ('maxs', '3i2'),
+    ('first_leafface', 'u2'), ('leafface_count', 'u2'),
+    ('first_leafbrush', 'u2'), ('leafbrush_count', 'u2'),
+    ('water_data_id', 'i2'),
+]
+
+# Version 0 leafs still carry their ambient light cube (6 RGBE colors), version 1 moved it to its own lump
+BSP_LEAF_DTYPES = {
+    0: np.dtype(BSP_LEAF_FIELDS + [('ambient_lighting', '(6,4)u1')], align=True),
+    1: np.dtype(BSP_LEAF_FIELDS, align=True),
+}
+
+# Static prop records (StaticPropLump_t) for each sprp game lump version, fields are natively aligned like the engine's
+STATIC_PROP_FIELDS_V4 = [
+    ('origin', '3f4'), ('angles', '3f4'),
+    ('prop_type', 'u2'), ('first_leaf', 'u2'), ('leaf_count', 'u2'),
+    ('solid', 'u1'), ('prop_flags', 'u1'), ('skin', 'i4'),
+    ('fade_min_dist', 'f4'), ('fade_max_dist', 'f4'),
+    ('lighting_origin', '3f4'),
+]
+STATIC_PROP_FIELDS_V5 = STATIC_PROP_FIELDS_V4 + [('forced_fade_scale', 'f4')]
+STATIC_PROP_FIELDS_V6 = STATIC_PROP_FIELDS_V5 + [('min_dx_level', 'u2'), ('max_dx_level', 'u2')]
+STATIC_PROP_FIELDS_V7 = STATIC_PROP_FIELDS_V6 + [('diffuse_modulation', '4u1')]
+STATIC_PROP_FIELDS_V8 = STATIC_PROP_FIELDS_V5 + [
+    ('min_cpu_level', 'u1'), ('max_cpu_level', 'u1'), ('min_gpu_level', 'u1'), ('max_gpu_level', 'u1'),
+    ('diffuse_modulation', '4u1'),
+]
+STATIC_PROP_FIELDS_V9 = STATIC_PROP_FIELDS_V8 + [('disable_x360', 'u1')]
+STATIC_PROP_FIELDS_V10 = STATIC_PROP_FIELDS_V9 + [('flags_ex', 'u4')]
+STATIC_PROP_FIELDS_V11 = STATIC_PROP_FIELDS_V10 + [('uniform_scale', 'f4')]
+
+# Some versions have more than one layout in the wild (TF2's v10 builds on v6), the record size picks between them
+STATIC_PROP_DTYPES = {
+    4: [np.dtype(STATIC_PROP_FIELDS_V4, align=True)],
+    5: [np.dtype(STATIC_PROP_FIELDS_V5, align=True)],
+    6: [np.dtype(STATIC_PROP_FIELDS_V6, align=True)],
+    7: [np.dtype(STATIC_PROP_FIELDS_V7, align=True)],
+    8: [np.dtype(STATIC_PROP_FIELDS_V8, align=True)],
+    9: [np.dtype(STATIC_PROP_FIELDS_V9, align=True)],
+    10: [
+        np.dtype(STATIC_PROP_FIELDS_V10, align=True),
+        np.dtype(STATIC_PROP_FIELDS_V6 + [('flags_ex', 'u4'), ('lightmap_res_x', 'u2'), ('lightmap_res_y', 'u2')], align=True),
+    ],
+    11: [np.dtype(STATIC_PROP_FIELDS_V11, align=True)],
+}
+
+StaticProps = namedtuple("StaticProps", "models leaves props")
+
+# Lumps that make up the decoded map: entities, texdata, vertices, texinfo, faces, edges, surfedges, models,
+# displacement info, displacement verts and texture names
+DECODED_LUMPS = [0, 2, 3, 6, 7, 12, 13, 14, 26, 33, 43, 44]
+PAKFILE_LUMP = 40
+
+# Decoded arrays stored in the parsed map cache, everything else is derived from them or read from the BSP on demand
+CACHED_ARRAYS = ('texdata', 'vertices', 'texinfo', 'faces', 'edges', 'surfedges', 'models', 'displacementinfo', 'displacement_verts', 'texstrtable')
+BSP_CACHE_VERSION = 2
+USE_BSP_CACHE = True
+
 HU_SCALE_FACTOR = 0.01904
 
 
+# Quoted string (braces inside it are just text), brace, or bare word
+ENTITY_TOKEN = re.compile(r'"([^"]*)"|([{}])|([^\s"{}]+)')
+
 def parse_entities(entitydata: str):
-    entities = []
-    lines = entitydata.splitlines()
+    """Tokenizes the entity lump in a single pass and returns every entity as a dict
 
-    for i in range(len(lines)):
-        if(lines[i].startswith('{')):
-            i += 1
+    Values aren't unescaped, just like the engine's parser, so paths ending in a backslash don't swallow the next quote
+    """
+    entities = []
+    entity = None
+    key = None
+    for quoted, brace, bare in ENTITY_TOKEN.findall(entitydata):
+        if(brace == '{'):
             entity = {}
-            while i < len(lines) and not lines[i].startswith('}'):
-                kv = [s for s in lines[i].split('"') if s != '' and s != ' ']
-                if(len(kv) == 2):
-                    entity[kv[0]] = kv[1]
-                i += 1
-
-            if('classname' in entity and 'origin' in entity):
+            key = None
+        elif(brace == '}'):
+            if(entity is not None):
                 entities.append(entity)
-    
+            entity = None
+        elif(entity is not None):
+            token = bare or quoted
+            if(key is None):
+                key = token
+            else:
+                entity[key] = token
+                key = None
+
     return entities
 
 
+def index_entities(entities: list, key: str):
+    """Groups entities by the value of `key`, entities without it are left out"""
+    index = {}
+    for e in entities:
+        value = e.get(key)
+        if(value is not None):
+            index.setdefault(value, []).append(e)
+
+    return index
+
+
+def index_brush_entities(entities: list):
+    """Brush entities by the number of the model they use (`"model" "*12"`)"""
+    return {
+        int(e['model'][1:]): e
+        for e in entities
+        if(e.get('model', '')[:1] == '*' and e['model'][1:].isdigit())
+    }
+
+
+def parse_game_lumps(data: bytes):
+    """Parses the game lump directory into a dict of four character id (e.g. 'sprp') -> BspGameLump"""
+    if(len(data) < 4):
+        return {}
+
+    count = struct.unpack_from('I', data)[0]
+    lumps = unpack_named(data[4:4 + count * 16], 'IHHII', BspGameLump)
+    game_lumps = {}
+    for i, lump in enumerate(lumps):
+        # Compressed game lumps store their uncompressed size, the compressed one is the distance to the next entry
+        # (which is why compressed maps end the directory with an empty dummy)
+        if(lump.flags & 1 and i + 1 < len(lumps)):
+            lump = lump._replace(size=lumps[i + 1].offset - lump.offset)
+        game_lumps.setdefault(struct.pack('>I', lump.id).decode('ascii', errors='replace'), lump)
+
+    return game_lumps
+
+
+def static_prop_dtype(version: int, stride: int):
+    """Record dtype for a static prop lump version, padded out to `stride` if the map's records are larger
+
+    `stride` may be None when there are no records to measure it from
+    """
+    candidates = STATIC_PROP_DTYPES.get(version)
+    if(candidates is None):
+        # Versions we don't know still start with the v4 fields (origin, angles, model index...), the rest is skipped
+        candidates = [np.dtype(STATIC_PROP_FIELDS_V4, align=True)]
+
+    for dtype in candidates:
+        if(stride is None or dtype.itemsize == stride):
+            return dtype
+
+    # Unknown layout: keep the fields of the largest known record that fits and skip the rest
+    fitting = [dtype for dtype in candidates if dtype.itemsize <= stride] or [np.dtype(STATIC_PROP_FIELDS_V4, align=True)]
+    dtype = max(fitting, key=lambda d: d.itemsize)
+    if(dtype.itemsize > stride):
+        raise Exception(f"Static prop records of {stride} bytes are too small for version {version}")
+    return np.dtype({
+        'names': dtype.names,
+        'formats': [dtype.fields[n][0] for n in dtype.names],
+        'offsets': [dtype.fields[n][1] for n in dtype.names],
+        'itemsize': stride,
+    })
+
+
+def decode_static_props(data: bytes, version: int):
+    """Decodes a (decompressed) sprp game lump: model dictionary, leaf list and a record array of props"""
+    data = memoryview(data)
+    pos = 0
+
+    model_count = struct.unpack_from('I', data, pos)[0]
+    pos += 4
+    names = np.frombuffer(data, 'S128', model_count, pos)
+    models = [n.decode('ascii', errors='replace') for n in names.tolist()]
+    pos += model_count * 128
+
+    leaf_count = struct.unpack_from('I', data, pos)[0]
+    pos += 4
+    leaves = np.frombuffer(data, np.uint16, leaf_count, pos)
+    pos += leaf_count * 2
+
+    prop_count = struct.unpack_from('I', data, pos)[0]
+    pos += 4
+    stride = (len(data) - pos) // prop_count if(prop_count > 0) else None
+    props = np.frombuffer(data, static_prop_dtype(version, stride), prop_count, pos)
+    return StaticProps(models, leaves, props.view(np.recarray))
+
+
 def parse_rgba(s: str, default=[1, 1, 1, 1]):
     split = s.split(' ')
     r = default
@@ -88,69 +289,330 @@ def parse_vector(s: str, default=[0,0,0], downscale=False):
 
 
 class BspData:
-    def __init__(self, br: BinaryReader, downscale=True):
+    """BSP file contents, every lump is only read and decoded the first time it's accessed
+
+    Backing the reader with a BufferFile over an mmap (see `open_mapped`) means lumps that are never touched are never read
+    """
+    def __init__(self, br: BinaryReader, downscale=True, name=None):
         self.downscale = downscale
         self.f = br
+        self.name = name or getattr(self.f.f, 'name', None)
         signature = self.f.readString(4)
         if(signature != 'VBSP'):
             raise Exception("Invalid BSP file (signature doesn't match)")
 
         self.version = self.f.read32()
         self.lumps = self.f.read_named(16 * 64, '4I', BspLump)
+        self.decompressed_lumps = {}
+
+    @staticmethod
+    def open_mapped(path: str, downscale=True):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return BspData(BinaryReader(BufferFile(data)), downscale, path)
+
+    @staticmethod
+    def open_cached(path: str, downscale=True, extra_lumps=[]):
+        """Opens a map like `open_mapped`, with its decoded lumps taken from the parsed map cache when possible
+
+        The cache is keyed by the contents of the BSP and the options that change the decoded data, so editing the map
+        or changing options never picks up a stale entry. Lumps outside the cache are still read from the mapped file,
+        the `extra_lumps` among them (e.g. the pakfile) are decompressed up front along with the others
+        """
+        data = BspData.open_mapped(path, downscale)
+        if(not USE_BSP_CACHE):
+            data.decompress_lumps(DECODED_LUMPS + list(extra_lumps))
+            return data
+
+        cache_path = data.cache_path()
+        if(data.load_cache(cache_path)):
+            data.decompress_lumps(extra_lumps)
+        else:
+            data.decompress_lumps(DECODED_LUMPS + list(extra_lumps))
+            data.save_cache(cache_path)
+
+        return data
+
+    def cache_path(self):
+        digest = hashlib.sha1(f"{BSP_CACHE_VERSION}:{self.downscale}:".encode('ascii'))
+        size = self.f.f.seek(0, 2)
+        self.f.seek(0, False)
+        digest.update(self.f.read_block(size))
+        return get_cache_path("bsp", digest.hexdigest() + ".npz")
+
+    def load_cache(self, cache_path: str):
+        """Fills in the decoded lumps from a cache file, returns False if there's no usable one"""
+        try:
+            with np.load(cache_path) as cache:
+                decoded = {}
+                for name in CACHED_ARRAYS:
+                    array = cache[name]
+                    decoded[name] = array.view(np.recarray) if array.dtype.names else array
+                decoded['texstrdata'] = cache['texstrdata'].tobytes()
+                decoded['entities'] = json.loads(str(cache['entities']))
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            if(os.path.exists(cache_path)):
+                print(f"[SourceSmoothie] Ignoring unreadable map cache {cache_path}: {e}")
+            return False
+
+        # Cached properties check the instance first, so these are used instead of reading the lumps
+        self.__dict__.update(decoded)
+        return True
+
+    def save_cache(self, cache_path: str):
+        arrays = {name: np.asarray(getattr(self, name)) for name in CACHED_ARRAYS}
+        arrays['texstrdata'] = np.frombuffer(self.texstrdata, np.uint8)
+        arrays['entities'] = np.array(json.dumps(self.entities, separators=(',', ':')))
+
+        # Swapped in once it's complete, so an interrupted import never leaves a broken cache behind
+        temp_path = cache_path + ".tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"[SourceSmoothie] Couldn't write map cache {cache_path}: {e}")
 
     def read(self):
-        self.f.seek(self.lumps[0].offset, False)
-        entitydata = try_decompress(self.f.f.read(self.lumps[0].size)).decode('ascii')
-        open("entities.kv", 'w').write(entitydata)
-        self.entities = parse_entities(entitydata)
-        self.model_origins = {}
-        for e in self.entities:
-            if(e.get('model') and e['model'][0] == "*"):
-                index = int(e['model'][1:])
-                origin = (
-                    parse_vector(e['origin'], downscale=self.downscale),
-                    parse_vector(e['angles']) if e.get('angles') else [0, 0, 0]
-                )
-
-                self.model_origins[index] = origin
-
-        self.f.seek(self.lumps[2].offset, False)
-        self.texdata = self.f.read_named(self.lumps[2].size, '3fI2I2I', BspTexData, decompress=True)
-
-        self.f.seek(self.lumps[3].offset, False)
-        self.vertices = self.f.read_iterative(self.lumps[3].size, '3f', decompress=True)
-        
-        self.f.seek(self.lumps[6].offset, False)
-        self.texinfo = self.f.read_named(self.lumps[6].size, '8f8fII', BspTexInfo, decompress=True)
-
-        self.f.seek(self.lumps[7].offset, False)
-        self.faces = self.f.read_named(self.lumps[7].size, 'HBBIhhhh4BIfIIIIIHHI', BspFace, decompress=True)
-
-        self.f.seek(self.lumps[12].offset, False)
-        self.edges = self.f.read_iterative(self.lumps[12].size, '2H', decompress=True)
-
-        self.f.seek(self.lumps[13].offset, False)
-        self.surfedges = self.f.read_iterative_single(self.lumps[13].size, 'i', decompress=True)
-
-        self.f.seek(self.lumps[14].offset, False)
-        self.models = self.f.read_named(self.lumps[14].size, '3f3f3fIII', BspModel, decompress=True)
-        
-        self.f.seek(self.lumps[26].offset, False)
-        self.displacementinfo = self.f.read_named(self.lumps[26].size, "3fiiiifiHii11Q5Q", BspDisplacementInfo, decompress=True)
-
-        self.f.seek(self.lumps[33].offset, False)
-        self.displacement_verts = self.f.read_named(self.lumps[33].size, "3fff", BspDisplacementVert, decompress=True)
-
-        self.f.seek(self.lumps[40].offset, False)
-        pakdata = try_decompress(self.f.f.read(self.lumps[40].size))
-        open("pak.zip", 'wb').write(pakdata)
-        # pakfile = zipfile.ZipFile("pak.zip")
-        vpk.mount("pak.zip")
-
-        self.f.seek(self.lumps[43].offset, False)
-        self.texstrdata = try_decompress(self.f.f.read(self.lumps[43].size))
-
-        self.f.seek(self.lumps[44].offset, False)
-        self.texstrtable = self.f.read_iterative_single(self.lumps[44].size, "I", decompress=True)
-
-        return True
\ No newline at end of file
+        """Decodes all lumps up front and mounts the pakfile"""
+        for name in ('entities', 'model_origins', 'texdata', 'vertices', 'texinfo', 'faces', 'edges', 'surfedges',
+                     'models', 'displacementinfo', 'displacement_verts', 'texstrdata', 'texstrtable'):
+            getattr(self, name)
+
+        self.mount_pakfile()
+        return True
+
+    @cached_property
+    def entities(self):
+        return parse_entities(bytes(self.read_lump(0)).decode('ascii', errors='replace'))
+
+    @cached_property
+    def entities_by_classname(self):
+        return index_entities(self.entities, 'classname')
+
+    @cached_property
+    def entities_by_targetname(self):
+        return index_entities(self.entities, 'targetname')
+
+    @cached_property
+    def entities_by_model(self):
+        return index_brush_entities(self.entities)
+
+    @cached_property
+    def model_origins(self):
+        return {
+            index: (
+                parse_vector(e.get('origin', '0 0 0'), downscale=self.downscale),
+                parse_vector(e['angles']) if e.get('angles') else [0, 0, 0]
+            )
+            for index, e in self.entities_by_model.items()
+        }
+
+    @cached_property
+    def texdata(self):
+        return self.read_lump_array(2, BSP_TEXDATA_DTYPE)
+
+    @cached_property
+    def vertices(self):
+        return self.read_lump_array(3, np.float32).reshape(-1, 3)
+
+    @cached_property
+    def texinfo(self):
+        return self.read_lump_array(6, BSP_TEXINFO_DTYPE)
+
+    @cached_property
+    def faces(self):
+        return self.read_lump_array(7, BSP_FACE_DTYPE)
+
+    @cached_property
+    def edges(self):
+        return self.read_lump_array(12, np.uint16).reshape(-1, 2)
+
+    @cached_property
+    def surfedges(self):
+        return self.read_lump_array(13, np.int32)
+
+    @cached_property
+    def models(self):
+        return self.read_lump_array(14, BSP_MODEL_DTYPE)
+
+    @cached_property
+    def displacementinfo(self):
+        return self.read_lump_array(26, BSP_DISPLACEMENT_INFO_DTYPE)
+
+    @cached_property
+    def displacement_verts(self):
+        return self.read_lump_array(33, BSP_DISPLACEMENT_VERT_DTYPE)
+
+    @cached_property
+    def nodes(self):
+        return self.read_lump_array(5, BSP_NODE_DTYPE)
+
+    @cached_property
+    def leafs(self):
+        return self.read_lump_array(10, BSP_LEAF_DTYPES.get(self.lumps[10].version, BSP_LEAF_DTYPES[1]))
+
+    @cached_property
+    def leaffaces(self):
+        return self.read_lump_array(16, np.uint16)
+
+    def leafs_in_box(self, mins, maxs, head_node=0):
+        """Indices of the leafs under `head_node` that overlap the box `mins`-`maxs` (Source units)
+
+        Walks the node tree and skips every subtree whose bounds are outside the box, so only the part of the map
+        around the box is visited
+        """
+        if(len(self.nodes) == 0):
+            return np.zeros(0, np.int64)
+
+        mins = np.asarray(mins)
+        maxs = np.asarray(maxs)
+        leafs = []
+        stack = [head_node]
+        while(len(stack) > 0):
+            index = stack.pop()
+            bounds = self.nodes[index] if index >= 0 else self.leafs[-1 - index]
+            if(np.any(bounds['mins'] > maxs) or np.any(bounds['maxs'] < mins)):
+                continue
+
+            if(index >= 0):
+                stack += bounds['children'].tolist()
+            else:
+                leafs.append(-1 - index)
+
+        return np.array(leafs, np.int64)
+
+    def leaf_faces(self, leafs: np.ndarray):
+        """Indices of the faces in the given leafs, every face only once"""
+        leafs = self.leafs[leafs]
+        first = leafs['first_leafface'].astype(np.int64)
+        count = leafs['leafface_count'].astype(np.int64)
+        offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return np.unique(self.leaffaces[np.repeat(first, count) + offsets].astype(np.int64))
+
+    @cached_property
+    def texstrdata(self):
+        return bytes(self.read_lump(43))
+
+    @cached_property
+    def texstrtable(self):
+        return self.read_lump_array(44, np.uint32)
+
+    @cached_property
+    def texture_names(self):
+        """Material name of every texdata entry"""
+        names = []
+        for offset in self.texstrtable[self.texdata.name_table_id]:
+            end = self.texstrdata.find(b'\0', offset)
+            names.append(self.texstrdata[offset:end if end >= 0 else None].decode('ascii', errors='replace'))
+        return names
+
+    @cached_property
+    def game_lumps(self):
+        """Game lump directory, by four character id (e.g. 'sprp')"""
+        return parse_game_lumps(self.read_lump(35))
+
+    def read_game_lump(self, id: str, max_size=None):
+        """(Decompressed) contents of a game lump, or only its first `max_size` bytes. None if the map doesn't have it"""
+        lump = self.game_lumps.get(id)
+        if(lump is None):
+            return None
+
+        self.f.seek(lump.offset, False)
+        return try_decompress(self.f.read_block(lump.size), max_size)
+
+    @cached_property
+    def static_props(self):
+        """StaticProps with the model dictionary, leaf list and a record array of all props (`static_props.props.origin` etc.)"""
+        data = self.read_game_lump('sprp')
+        if(data is None or len(data) < 4):
+            return StaticProps([], np.zeros(0, np.uint16), np.zeros(0, STATIC_PROP_DTYPES[4][0]).view(np.recarray))
+
+        return decode_static_props(data, self.game_lumps['sprp'].version)
+
+    @cached_property
+    def static_prop_models(self):
+        """Model paths in the static prop dictionary, read without decoding the prop records"""
+        if('static_props' in self.__dict__):
+            return self.static_props.models
+
+        header = self.read_game_lump('sprp', 4)
+        if(header is None or len(header) < 4):
+            return []
+
+        count = struct.unpack_from('I', header)[0]
+        data = self.read_game_lump('sprp', 4 + count * 128)
+        names = np.frombuffer(data, 'S128', min(count, (len(data) - 4) // 128), 4)
+        return [n.decode('ascii', errors='replace') for n in names.tolist()]
+
+    def read_lump(self, index: int):
+        """Raw (decompressed) contents of a lump, a memoryview into the file when it's backed by a BufferFile"""
+        if(index in self.decompressed_lumps):
+            return self.decompressed_lumps.pop(index)
+
+        self.f.seek(self.lumps[index].offset, False)
+        return self.f.read_block(self.lumps[index].size, decompress=True)
+
+    def compressed_lumps(self, indices=None):
+        """Finds the LZMA compressed lumps among `indices` (all of them by default) by reading only their headers
+
+        Returns a dict of lump index -> LzmaHeader
+        """
+        compressed = {}
+        for i in (range(len(self.lumps)) if indices is None else indices):
+            if(self.lumps[i].size < LZMA_HEADER_SIZE):
+                continue
+
+            self.f.seek(self.lumps[i].offset, False)
+            header = lzma_header(self.f.read_block(LZMA_HEADER_SIZE))
+            if(header):
+                compressed[i] = header
+
+        return compressed
+
+    def decompress_lumps(self, indices=None, workers=None):
+        """Decompresses the compressed lumps among `indices` concurrently, ahead of their first access
+
+        lzma releases the GIL, so a thread pool gets close to linear scaling. The largest lumps are started first so
+        they don't end up running alone at the end
+        """
+        compressed = self.compressed_lumps(indices)
+        pending = [i for i in sorted(compressed, key=lambda i: compressed[i].actual_size, reverse=True) if i not in self.decompressed_lumps]
+        if(len(pending) == 0):
+            return
+
+        # Blocks are read on this thread, the workers only get buffers so they don't fight over the file position
+        blocks = []
+        for i in pending:
+            self.f.seek(self.lumps[i].offset, False)
+            blocks.append(self.f.read_block(self.lumps[i].size))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i, data in zip(pending, pool.map(try_decompress, blocks)):
+                if(len(data) != compressed[i].actual_size):
+                    raise Exception(f"Lump {i} decompressed to {len(data)} bytes, expected {compressed[i].actual_size}")
+                self.decompressed_lumps[i] = data
+
+    def read_lump_array(self, index: int, dtype):
+        """Decodes a lump into a read-only array without creating an object per record
+
+        Structured lumps are returned as record arrays, so `faces[i].texinfo` works just like it did with namedtuples,
+        and whole columns can be taken with `faces.texinfo`
+        """
+        dtype = np.dtype(dtype)
+        data = self.read_lump(index)
+        array = np.frombuffer(data, dtype, count=len(data) // dtype.itemsize)
+        return array.view(np.recarray) if dtype.names else array
+
+    def mount_pakfile(self):
+        if(getattr(self, 'pakfile_name', None)):
+            return
+
+        # Files embedded in the map replace the game's, and replace the ones of any map that was imported before
+        self.pakfile_name = f"pakfile:{self.name or id(self)}"
+        vpk.mount_override(self.pakfile_name, vpk.ZipWrapper(self.pakfile_name, self.read_lump(PAKFILE_LUMP)))
+
+    def unmount_pakfile(self):
+        if(getattr(self, 'pakfile_name', None)):
+            vpk.unmount(self.pakfile_name)
+            self.pakfile_name = None
\ No newline at end of file
@@ -0,0 +1,462 @@
+"""Mesh arrays for BSP brush geometry, computed for whole models at once with NumPy
+
+The importer only copies the results into meshes with foreach_set
+"""
+from collections import namedtuple
+import numpy as np
+from .bsp_data import BspData, parse_vector
+
+# Trigger, nodraw and skip surfaces never end up in the imported mesh
+SKIPPED_SURFACE_FLAGS = 0x2c0
+
+# Displacement vertices closer than this (in Source units) are merged into one
+DISPLACEMENT_WELD_DISTANCE = 0.001
+
+# vertex_alpha is the displacement blend alpha (0-1), brush faces have none
+BrushMesh = namedtuple("BrushMesh", "vertices loop_vertices loop_starts loop_totals loop_uvs face_texdata vertex_alpha")
+
+
+def model_faces(data: BspData, model_index: int, region=None):
+    """Drawable faces of a brush model, split into (regular faces, displacement faces) face index arrays
+
+    With a region (a (mins, maxs) box in Source units), only the faces that overlap it are returned
+    """
+    m = data.models[model_index]
+    if(region is not None):
+        faces = region_faces(data, model_index, *region)
+    else:
+        faces = np.arange(m.first_face, m.first_face + m.face_count)
+
+    texinfo = data.faces.texinfo[faces].astype(np.int64)
+    drawable = texinfo >= 0
+    drawable[drawable] = (data.texinfo.surface_flags[texinfo[drawable]] & SKIPPED_SURFACE_FLAGS) == 0
+
+    displacement = data.faces.dispinfo[faces] != -1
+    regular = drawable & ~displacement & (data.faces.edge_count[faces] >= 3)
+    return faces[regular], faces[drawable & displacement]
+
+
+def region_faces(data: BspData, model_index: int, mins, maxs):
+    """Faces of a brush model that overlap the box `mins`-`maxs` (Source units), in face order
+
+    Candidates are the faces of the leafs the node tree finds around the box, plus the model's displacements, which
+    aren't part of any leaf's face list. Only the candidates are checked against the box, not the whole model
+    """
+    m = data.models[model_index]
+    first, last = m.first_face, m.first_face + m.face_count
+    leaf_faces = data.leaf_faces(data.leafs_in_box(mins, maxs, m.head_node))
+    leaf_faces = leaf_faces[(leaf_faces >= first) & (leaf_faces < last)]
+    displacements = first + np.flatnonzero(data.faces.dispinfo[first:last] != -1)
+    return faces_in_box(data, np.union1d(leaf_faces, displacements), mins, maxs)
+
+
+def faces_in_box(data: BspData, faces: np.ndarray, mins, maxs):
+    """The faces among `faces` whose corners, or displaced surface for displacements, overlap the box `mins`-`maxs`"""
+    if(len(faces) == 0):
+        return faces
+
+    loop_vertices, loop_starts, _ = face_loop_vertices(data, faces)
+    positions = data.vertices[loop_vertices]
+    face_mins = np.minimum.reduceat(positions, loop_starts)
+    face_maxs = np.maximum.reduceat(positions, loop_starts)
+
+    displacement = data.faces.dispinfo[faces] != -1
+    if(np.any(displacement)):
+        reach = displacement_reach(data, faces[displacement])[:, None]
+        face_mins[displacement] -= reach
+        face_maxs[displacement] += reach
+
+    return faces[np.all((face_mins <= maxs) & (face_maxs >= mins), axis=1)]
+
+
+def model_in_box(data: BspData, model_index: int, mins, maxs):
+    """Whether the bounds of a brush model, moved to its entity's origin, overlap the box `mins`-`maxs` (Source units)"""
+    m = data.models[model_index]
+    origin = np.array(parse_vector(data.entities_by_model.get(model_index, {}).get('origin', '0 0 0')) or [0, 0, 0])
+    model_mins = np.array([m.min_x, m.min_y, m.min_z]) + origin
+    model_maxs = np.array([m.max_x, m.max_y, m.max_z]) + origin
+    return bool(np.all(model_mins <= maxs) and np.all(model_maxs >= mins))
+
+
+def face_loop_vertices(data: BspData, faces: np.ndarray):
+    """Vertex lump index of every corner of `faces`, along with the loop start and loop count of each face
+
+    Corners are returned in reverse surfedge order, which is the winding Blender expects
+    """
+    first_edge = data.faces.first_edge[faces].astype(np.int64)
+    edge_count = data.faces.edge_count[faces].astype(np.int64)
+
+    loop_totals = edge_count
+    loop_starts = np.cumsum(edge_count) - edge_count
+    corner = np.arange(loop_totals.sum()) - np.repeat(loop_starts, edge_count)
+
+    surfedges = data.surfedges[np.repeat(first_edge + edge_count - 1, edge_count) - corner].astype(np.int64)
+    # Negative surfedges walk their edge backwards, so the corner is the edge's second vertex
+    loop_vertices = data.edges[np.abs(surfedges), (surfedges < 0).astype(np.int64)].astype(np.int64)
+    return loop_vertices, loop_starts, loop_totals
+
+
+def texture_vectors(data: BspData, texinfo: np.ndarray):
+    """s and t texture vectors (xyz + offset) of the given texinfo entries, as two (N, 4) arrays"""
+    ti = data.texinfo[texinfo]
+    s = np.stack([ti.uv0_0, ti.uv0_1, ti.uv0_2, ti.uv0_3], axis=-1)
+    t = np.stack([ti.uv1_0, ti.uv1_1, ti.uv1_2, ti.uv1_3], axis=-1)
+    return s, t
+
+
+def project_uvs(positions: np.ndarray, s: np.ndarray, t: np.ndarray, width: np.ndarray, height: np.ndarray):
+    """Projects (N, 3) positions with per-position s/t texture vectors (N, 4) and texture sizes into (N, 2) UVs"""
+    width = np.where(width > 0, width, 1).astype(np.float32)
+    height = np.where(height > 0, height, 1).astype(np.float32)
+
+    uvs = np.empty((len(positions), 2), np.float32)
+    uvs[:, 0] = (np.einsum('ij,ij->i', positions, s[:, :3]) + s[:, 3]) / width
+    uvs[:, 1] = -(np.einsum('ij,ij->i', positions, t[:, :3]) + t[:, 3]) / height
+    return uvs
+
+
+def compute_uvs(data: BspData, positions: np.ndarray, texinfo: np.ndarray):
+    """Texture coordinates of `positions` (N, 3) in Source units, each projected with its own texinfo entry"""
+    s, t = texture_vectors(data, texinfo)
+    td = data.texdata[data.texinfo.texdata[texinfo]]
+    return project_uvs(positions, s, t, td.width, td.height)
+
+
+def displacement_corners(data: BspData, faces: np.ndarray):
+    """Corners (N, 4, 3) of displacement faces, rotated so the first one is each displacement's start position
+
+    All faces must have 4 edges
+    """
+    first_edge = data.faces.first_edge[faces].astype(np.int64)
+    surfedges = data.surfedges[first_edge[:, None] + np.arange(4)].astype(np.int64)
+    corners = data.vertices[data.edges[np.abs(surfedges), (surfedges < 0).astype(np.int64)]].astype(np.float64)
+
+    di = data.displacementinfo[data.faces.dispinfo[faces]]
+    start = np.stack([di.start_x, di.start_y, di.start_z], axis=-1).astype(np.float64)
+    base_index = np.argmin(np.abs(corners - start[:, None]).sum(axis=2), axis=1)
+    corners = np.take_along_axis(corners, ((base_index[:, None] + np.arange(4)) % 4)[:, :, None], axis=1)
+    corners[:, 0] = start
+    return corners
+
+
+def displacement_reach(data: BspData, faces: np.ndarray):
+    """How far the furthest vertex of each displacement face is pushed out of its base face"""
+    di = data.displacementinfo[data.faces.dispinfo[faces]]
+    counts = ((1 << di.power.astype(np.int64)) + 1) ** 2
+    starts = np.cumsum(counts) - counts
+    first = np.abs(di.disp_vert_start.astype(np.int64))
+    dist = np.abs(data.displacement_verts.dist[np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(starts, counts)])
+    return np.maximum.reduceat(dist, starts)
+
+
+def displacement_grids(data: BspData, faces: np.ndarray, power: int):
+    """Displaced positions (N, verts_wide * verts_wide, 3) and alphas (N, verts_wide * verts_wide) of displacements with the same power
+
+    Rows of each grid are interpolated between the corner edges, then every vertex is pushed out by its `dist * vec`
+    """
+    verts_wide = (2 << (power - 1)) + 1
+    corners = displacement_corners(data, faces)
+    low_base = corners[:, None, None, 0]
+    low_ray = corners[:, None, None, 1] - low_base
+    high_base = corners[:, None, None, 3]
+    high_ray = corners[:, None, None, 2] - high_base
+
+    f = np.linspace(0.0, 1.0, verts_wide)
+    fy = f[None, :, None, None]
+    fx = f[None, None, :, None]
+    mid_base = low_base + low_ray * fy
+    mid_ray = high_base + high_ray * fy - mid_base
+    grids = (mid_base + mid_ray * fx).reshape(len(faces), -1, 3)
+
+    first = np.abs(data.displacementinfo.disp_vert_start[data.faces.dispinfo[faces]].astype(np.int64))
+    dv = data.displacement_verts[first[:, None] + np.arange(verts_wide * verts_wide)]
+    grids += np.stack([dv.vx, dv.vy, dv.vz], axis=-1) * dv.dist[..., None]
+    return grids.astype(np.float32), dv.alpha.astype(np.float32)
+
+
+def displacement_quads(verts_wide: int):
+    """Grid indices of the corners of every quad in a displacement, (quads, 4) in Blender's winding"""
+    x, y = np.meshgrid(np.arange(verts_wide - 1), np.arange(verts_wide - 1))
+    i = (x + y * verts_wide).ravel()
+    return np.stack([i, i + 1, i + verts_wide + 1, i + verts_wide], axis=-1)
+
+
+def build_displacement_mesh(data: BspData, faces: np.ndarray):
+    """Vertex, loop, polygon, UV and alpha arrays for the displacement `faces` of a model, laid out like `build_brush_mesh`
+
+    Displacements are computed in batches of equal power. Quads within a displacement share their grid vertices
+    """
+    valid = data.faces.edge_count[faces] == 4
+    for fi in faces[~valid].tolist():
+        print(f"[SourceSmoothie] Bad displacement (face #{fi})")
+    faces = faces[valid]
+
+    powers = data.displacementinfo.power[data.faces.dispinfo[faces]]
+    meshes = []
+    for power in np.unique(powers).tolist():
+        batch = faces[powers == power]
+        verts_wide = (2 << (power - 1)) + 1
+        grids, alpha = displacement_grids(data, batch, power)
+
+        quads = displacement_quads(verts_wide)
+        grid_size = verts_wide * verts_wide
+        loop_vertices = (quads[None] + (np.arange(len(batch)) * grid_size)[:, None, None]).ravel()
+        vertices = grids.reshape(-1, 3)
+
+        texinfo = data.faces.texinfo[batch].astype(np.int64)
+        vertex_uvs = compute_uvs(data, vertices, np.repeat(texinfo, grid_size))
+        quad_count = len(batch) * len(quads)
+        meshes.append(BrushMesh(
+            vertices,
+            loop_vertices,
+            np.arange(quad_count) * 4,
+            np.full(quad_count, 4),
+            vertex_uvs[loop_vertices],
+            np.repeat(data.texinfo.texdata[texinfo].astype(np.int64), len(quads)),
+            alpha.ravel() / 255,
+        ))
+
+    if(len(meshes) == 0):
+        return empty_mesh()
+
+    return weld_displacements(merge_meshes(meshes))
+
+
+# Cell offsets that cover every pair of neighbouring grid cells once: the cell itself and the 13 "forward" neighbours
+NEIGHBOUR_CELLS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) if (dx, dy, dz) >= (0, 0, 0)]
+
+
+def weld_pairs(vertices: np.ndarray, distance: float):
+    """Index pairs (a, b) of the vertices that are at most `distance` apart
+
+    Vertices are binned in a grid of cells no smaller than `distance`, so only vertices in the same or neighbouring
+    cells are compared. Cells are packed into one int64 key per vertex (21 bits per axis), the grid is coarsened for
+    very large meshes so it fits
+    """
+    lo = vertices.min(axis=0)
+    cell_size = max(distance, float((vertices.max(axis=0) - lo).max()) / (1 << 20))
+    # Offset by one so the neighbours of the first cell still have non-negative coordinates
+    cells = np.floor((vertices - lo) / cell_size).astype(np.int64) + 1
+    keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    pairs_a = []
+    pairs_b = []
+    for dx, dy, dz in NEIGHBOUR_CELLS:
+        # Cells are matched with their occupied neighbour first, vertices are only paired up for those
+        neighbour = cell_keys + ((dx << 42) + (dy << 21) + dz)
+        index = np.minimum(np.searchsorted(cell_keys, neighbour), len(cell_keys) - 1)
+        cell_a = np.flatnonzero(cell_keys[index] == neighbour)
+        cell_b = index[cell_a]
+
+        # Every vertex of cell_a against every vertex of cell_b
+        pair_count = cell_counts[cell_a] * cell_counts[cell_b]
+        count_b = np.repeat(cell_counts[cell_b], pair_count)
+        pair = np.arange(pair_count.sum()) - np.repeat(np.cumsum(pair_count) - pair_count, pair_count)
+        a = order[np.repeat(cell_starts[cell_a], pair_count) + pair // count_b]
+        b = order[np.repeat(cell_starts[cell_b], pair_count) + pair % count_b]
+        # Within the same cell every pair is found from both ends, keep one
+        keep = (a < b) if (dx, dy, dz) == (0, 0, 0) else (a != b)
+        keep &= ((vertices[a] - vertices[b]) ** 2).sum(axis=1) <= distance * distance
+        pairs_a.append(a[keep])
+        pairs_b.append(b[keep])
+
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def weld_displacements(mesh: BrushMesh):
+    """Merges displacement vertices closer than DISPLACEMENT_WELD_DISTANCE (edges shared with neighbouring displacements)
+
+    Vertices that are linked through close pairs all end up as the first one of their group
+    """
+    if(len(mesh.vertices) == 0):
+        return mesh
+
+    a, b = weld_pairs(mesh.vertices.astype(np.float64), DISPLACEMENT_WELD_DISTANCE)
+    # Every vertex takes the lowest index in its group, spread along the pairs until nothing changes
+    labels = np.arange(len(mesh.vertices))
+    while(True):
+        lowest = np.minimum(labels[a], labels[b])
+        spread = labels.copy()
+        np.minimum.at(spread, a, lowest)
+        np.minimum.at(spread, b, lowest)
+        spread = spread[spread]
+        if(np.array_equal(spread, labels)):
+            break
+        labels = spread
+
+    _, first, remap = np.unique(labels, return_index=True, return_inverse=True)
+    return mesh._replace(
+        vertices=mesh.vertices[first],
+        loop_vertices=remap.ravel()[mesh.loop_vertices],
+        vertex_alpha=mesh.vertex_alpha[first],
+    )
+
+
+def empty_mesh():
+    return BrushMesh(
+        np.zeros((0, 3), np.float32), np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64),
+        np.zeros((0, 2), np.float32), np.zeros(0, np.int64), np.zeros(0, np.float32),
+    )
+
+
+def merge_meshes(meshes: list):
+    """Concatenates BrushMesh arrays into a single mesh, offsetting the vertex and loop indices"""
+    vertex_offsets = np.cumsum([0] + [len(m.vertices) for m in meshes])
+    loop_offsets = np.cumsum([0] + [len(m.loop_vertices) for m in meshes])
+    return BrushMesh(
+        np.concatenate([m.vertices for m in meshes]),
+        np.concatenate([m.loop_vertices + o for m, o in zip(meshes, vertex_offsets)]),
+        np.concatenate([m.loop_starts + o for m, o in zip(meshes, loop_offsets)]),
+        np.concatenate([m.loop_totals for m in meshes]),
+        np.concatenate([m.loop_uvs for m in meshes]),
+        np.concatenate([m.face_texdata for m in meshes]),
+        np.concatenate([m.vertex_alpha for m in meshes]),
+    )
+
+
+def build_brush_mesh(data: BspData, faces: np.ndarray):
+    """Vertex, loop, polygon and UV arrays for the regular (non-displacement) `faces` of a model
+
+    Faces share the map's own vertices, remapped to the ones the model uses, so nothing has to be welded afterwards
+    """
+    lump_vertices, loop_starts, loop_totals = face_loop_vertices(data, faces)
+    used_vertices, loop_vertices = np.unique(lump_vertices, return_inverse=True)
+    vertices = data.vertices[used_vertices]
+
+    texinfo = data.faces.texinfo[faces].astype(np.int64)
+    loop_uvs = compute_uvs(data, vertices[loop_vertices], np.repeat(texinfo, loop_totals))
+
+    return BrushMesh(
+        vertices,
+        loop_vertices.ravel(),
+        loop_starts,
+        loop_totals,
+        loop_uvs,
+        data.texinfo.texdata[texinfo].astype(np.int64),
+        np.zeros(len(vertices), np.float32),
+    )
+
+
+def select_faces(mesh: BrushMesh, keep: np.ndarray):
+    """Mesh with only the faces in the `keep` mask, and only the vertices those faces use"""
+    keep_loops = np.repeat(keep, mesh.loop_totals)
+    used_vertices, loop_vertices = np.unique(mesh.loop_vertices[keep_loops], return_inverse=True)
+    loop_totals = mesh.loop_totals[keep]
+    return BrushMesh(
+        mesh.vertices[used_vertices],
+        loop_vertices.ravel(),
+        np.cumsum(loop_totals) - loop_totals,
+        loop_totals,
+        mesh.loop_uvs[keep_loops],
+        mesh.face_texdata[keep],
+        mesh.vertex_alpha[used_vertices],
+    )
+
+
+def reorder_faces(mesh: BrushMesh, order: np.ndarray):
+    """Mesh with its faces, and their loops, in the given order"""
+    loop_totals = mesh.loop_totals[order]
+    loop_starts = np.cumsum(loop_totals) - loop_totals
+    loops = np.repeat(mesh.loop_starts[order] - loop_starts, loop_totals) + np.arange(loop_totals.sum())
+    return mesh._replace(
+        loop_vertices=mesh.loop_vertices[loops],
+        loop_starts=loop_starts,
+        loop_totals=loop_totals,
+        loop_uvs=mesh.loop_uvs[loops],
+        face_texdata=mesh.face_texdata[order],
+    )
+
+
+def slice_faces(mesh: BrushMesh, start: int, end: int):
+    """Mesh with only the faces `start` to `end` and the vertices they use, their loops must be back to back"""
+    loop_totals = mesh.loop_totals[start:end]
+    first_loop = mesh.loop_starts[start]
+    last_loop = mesh.loop_starts[end - 1] + loop_totals[-1]
+    used_vertices, loop_vertices = np.unique(mesh.loop_vertices[first_loop:last_loop], return_inverse=True)
+    return BrushMesh(
+        mesh.vertices[used_vertices],
+        loop_vertices.ravel(),
+        np.cumsum(loop_totals) - loop_totals,
+        loop_totals,
+        mesh.loop_uvs[first_loop:last_loop],
+        mesh.face_texdata[start:end],
+        mesh.vertex_alpha[used_vertices],
+    )
+
+
+def remove_invalid_faces(mesh: BrushMesh):
+    """Drops faces that use a vertex more than once, and faces that use the same vertices as an earlier face
+
+    Faces are keyed by their sorted vertex indices, so duplicates are found with one np.unique per face size
+    """
+    face_count = len(mesh.loop_totals)
+    if(face_count == 0):
+        return mesh
+
+    keep = np.ones(face_count, bool)
+    for total in np.unique(mesh.loop_totals).tolist():
+        group = np.nonzero(mesh.loop_totals == total)[0]
+        keys = np.sort(mesh.loop_vertices[mesh.loop_starts[group, None] + np.arange(total)], axis=1)
+
+        degenerate = (keys[:, 1:] == keys[:, :-1]).any(axis=1)
+        keep[group[degenerate]] = False
+
+        group = group[~degenerate]
+        _, first = np.unique(keys[~degenerate], axis=0, return_index=True)
+        duplicate = np.ones(len(group), bool)
+        duplicate[first] = False
+        keep[group[duplicate]] = False
+
+    return mesh if(keep.all()) else select_faces(mesh, keep)
+
+
+def face_centers(mesh: BrushMesh):
+    """Average position of the corners of every face"""
+    positions = mesh.vertices[mesh.loop_vertices].astype(np.float64)
+    return np.add.reduceat(positions, mesh.loop_starts, axis=0) / mesh.loop_totals[:, None]
+
+
+def split_into_chunks(mesh: BrushMesh, target_polygons: int):
+    """Splits a mesh into meshes of roughly `target_polygons` faces, by binning face centers on a uniform XY grid
+
+    The grid has about one cell per `target_polygons` faces, shaped after the mesh's footprint. Cells without faces
+    are skipped, and cells that end up with more than twice the target (dense areas) get a grid of their own
+    """
+    face_count = len(mesh.loop_totals)
+    if(target_polygons <= 0 or face_count <= target_polygons):
+        return [mesh]
+
+    centers = face_centers(mesh)[:, :2]
+    low = centers.min(axis=0)
+    size = np.maximum(centers.max(axis=0) - low, 1e-3)
+
+    cell_count = -(-face_count // target_polygons)
+    cells_x = max(1, int(round(np.sqrt(cell_count * size[0] / size[1]))))
+    cells_y = max(1, -(-cell_count // cells_x))
+
+    cell_x = np.clip(((centers[:, 0] - low[0]) / size[0] * cells_x).astype(np.int64), 0, cells_x - 1)
+    cell_y = np.clip(((centers[:, 1] - low[1]) / size[1] * cells_y).astype(np.int64), 0, cells_y - 1)
+    cells = cell_x + cell_y * cells_x
+
+    # Faces are sorted by cell once, so every chunk is a contiguous slice of them
+    counts = np.bincount(cells)
+    used_cells = np.flatnonzero(counts).tolist()
+    if(len(used_cells) == 1):
+        return [mesh] # All faces are centered in the same spot, there's nothing left to split on
+
+    ends = np.cumsum(counts)
+    sorted_mesh = reorder_faces(mesh, np.argsort(cells, kind='stable'))
+    chunks = []
+    for cell in used_cells:
+        chunk = slice_faces(sorted_mesh, ends[cell] - counts[cell], ends[cell])
+        if(len(chunk.loop_totals) > target_polygons * 2):
+            subchunks = split_into_chunks(chunk, target_polygons)
+            if(len(subchunks) > 1):
+                chunks += subchunks
+                continue
+
+        chunks.append(chunk)
+
+    return chunks
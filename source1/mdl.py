@@ -9,7 +9,7 @@ from .mdl_data import (MdlData, HU_SCALE_FACTOR)
 from bpy.props import (StringProperty, BoolProperty)
 from bpy_extras.io_utils import (ImportHelper)
 from .vmt import (load_vmt, createNoneMaterial, createNoneTexture)
-from ..shared.binhelper import (BinaryReader)
+from ..shared.binhelper import (BinaryReader, BufferFile)
 from ..shared import vpk
 from ..shared.utils import *
 
@@ -94,9 +94,10 @@ class MdlLoader(bpy.types.Operator, ImportHelper):
     downscale: BoolProperty(name="Rescale model (recommended)", default=True)
 
     def execute(self, context):
-        self.mdl_file = BinaryReader(open(self.filepath, 'rb'))
-        self.vvd_file = BinaryReader(open(self.filepath[:-3] + "vvd", 'rb'))
-        self.vtx_file = BinaryReader(open(self.filepath[:-3] + "dx90.vtx", 'rb'))
+        self.mdl_file, self.vvd_file, self.vtx_file = [
+            BinaryReader(BufferFile(open(path, 'rb').read()))
+            for path in (self.filepath, self.filepath[:-3] + "vvd", self.filepath[:-3] + "dx90.vtx")
+        ]
         if(not self.load()):
             return {'CANCELLED'}
 
@@ -62,14 +62,11 @@ class VvdData:
 
         self.f.seek(self.vertex_offset, False)
 
-        self.vertices = []
-        for i in range(self.lod_vertex_count[DEFAULT_LOD]):
-            self.f.seek(16) # Skip bone weights for now
-            self.vertices.append(VvdVertex(
-                self.f.readVec3(),
-                self.f.readVec3(),
-                self.f.readVec2()
-            ))
+        # Bone weights (the first 16 bytes of every vertex) are skipped for now
+        self.vertices = [
+            VvdVertex(v[0:3], v[3:6], v[6:8])
+            for v in self.f.read_iterative(self.lod_vertex_count[DEFAULT_LOD] * 48, "16x3f3f2f")
+        ]
 
         return True
 
@@ -264,15 +261,11 @@ class VtxData:
 
         flags = self.f.read8()
 
-        indices = []
-        verts = []
         with self.f.save_pos():
             self.f.seek(cpos + indices_offset, False)
-            for i in range(indices_count):
-                indices.append(self.f.read16())
+            indices = self.f.read_iterative_single(indices_count * 2, "H")
 
             self.f.seek(cpos + verts_offset, False)
-            for i in range(verts_count):
-                verts.append(VtxVertex._make(self.f.readt("4BH3B")))
+            verts = self.f.read_named(verts_count * 9, "4BH3B", VtxVertex)
         
         return VtxStripGroup._make((verts, indices))
\ No newline at end of file
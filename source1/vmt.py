@@ -70,6 +70,24 @@ def parse_kv(source: str):
     return keys
 
 
+def prefetch_materials(paths):
+    """Read a batch of VMT files (and the materials they include) in one go, returns {path: vmt bytes}"""
+    materials, _ = vpk.open_many(paths)
+
+    # Included materials land in the file cache, so load_vmt picks them up without going back to the archives
+    includes = []
+    for data in materials.values():
+        try:
+            imported_material = parse_kv(data.decode('utf-8'))
+        except:
+            continue
+        if('include' in imported_material):
+            includes.append(imported_material['include'])
+    vpk.open_many(includes)
+
+    return materials
+
+
 def load_vmt(file: BinaryReader, name, diffuse_colour=[1.0, 1.0, 1.0, 1.0]):
     imported_material = parse_kv(file.read().decode('utf-8'))
     if('include' in imported_material):